@@ -0,0 +1,95 @@
+'''
+Gateway memory per idle client connection.
+
+Each run happens in a fresh process and reports the growth of its RSS
+divided by the number of connections. The connection column covers what
+GTcpServer keeps for a client: the GTcpConnection, its decoder, the
+server's bookkeeping attributes and the _clients entry, with a stub in
+place of the IOStream since hundreds of thousands of real sockets do not
+fit in one process here. The iostream column is the cost of tornado's
+IOStream objects alone, built around one shared socket and never read.
+'''
+import os
+import sys
+import socket
+import resource
+from multiprocessing import Process
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(curr_dir)
+sys.path.append(os.path.join(curr_dir, '../'))
+
+from gtcp import tcp_server
+
+CONNECTION_COUNTS = [10000, 100000, 500000]
+
+class BenchConfig(object):
+	CONNECTION_ID_RANDOM_PADDING = True
+	ENABLE_KEEP_ALIVE = False
+	TCP_MAX_PACKET_SIZE = 262144
+
+class StubSocket(object):
+
+	family = socket.AF_INET
+
+class StubStream(object):
+
+	__slots__ = ()
+
+	socket = StubSocket()
+
+	def set_close_callback(self, callback):
+		return
+
+	def read_bytes(self, num_bytes, callback, partial=False):
+		return
+
+	def closed(self):
+		return False
+
+def get_rss():
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * resource.getpagesize()
+	except IOError:
+		# ru_maxrss is in kilobytes on linux and in bytes on osx, this fallback assumes linux
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def on_packet(client, data):
+	return
+
+def on_close(client):
+	return
+
+def bench_connections(count):
+	clients = {}
+	stream = StubStream()
+	start_rss = get_rss()
+	for i in xrange(count):
+		client = tcp_server.GTcpConnection(stream, ('10.%u.%u.%u' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), 1024 + (i & 0x7fff)), BenchConfig, on_packet, on_close)
+		clients[client.id] = client
+		client.sticky_worker = None
+		client.sticky_ring_version = -1
+		client.queued_tasks = 0
+		client.queued_lane = None
+	print 'connection  count=%-7d %6.0f bytes/connection' % (count, float(get_rss() - start_rss) / count)
+
+def bench_iostreams(count):
+	from tornado.iostream import IOStream
+	reader, writer = socket.socketpair()
+	streams = []
+	start_rss = get_rss()
+	for i in xrange(count):
+		streams.append(IOStream(reader))
+	print 'iostream    count=%-7d %6.0f bytes/stream' % (count, float(get_rss() - start_rss) / count)
+
+def run(target, count):
+	p = Process(target=target, args=(count,))
+	p.start()
+	p.join()
+
+if __name__ == "__main__":
+	for count in CONNECTION_COUNTS:
+		run(bench_connections, count)
+	for count in CONNECTION_COUNTS:
+		run(bench_iostreams, count)
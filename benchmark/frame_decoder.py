@@ -0,0 +1,88 @@
+'''
+Cost of receiving pipelined packets on a tornado stream.
+
+The writer end of a socket pair sends bursts of packets and the reader
+end decodes them on the IOLoop, once with a read_bytes call for the
+header and another for the body of every packet, as GTcpConnection did
+before, and once with a partial read fed to FrameDecoder.
+'''
+import os
+import sys
+import time
+import socket
+import struct
+import threading
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(curr_dir)
+sys.path.append(os.path.join(curr_dir, '../'))
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from gtcp.frame_decoder import FrameDecoder
+
+PACKET_COUNT = 200000
+BURST_SIZE = 100
+PACKET_SIZES = [50, 200, 1024]
+READ_CHUNK_SIZE = 65536
+
+class TwoReadReceiver(object):
+
+	def __init__(self, stream, on_packet):
+		self._stream = stream
+		self._on_packet = on_packet
+		self._stream.read_bytes(4, self._on_recv_header)
+
+	def _on_recv_header(self, data):
+		(body_size,) = struct.unpack('<I', data)
+		self._stream.read_bytes(body_size, self._on_recv_body)
+
+	def _on_recv_body(self, data):
+		self._on_packet(data)
+		self._stream.read_bytes(4, self._on_recv_header)
+
+class DecoderReceiver(object):
+
+	def __init__(self, stream, on_packet):
+		self._stream = stream
+		self._on_packet = on_packet
+		self._decoder = FrameDecoder()
+		self._stream.read_bytes(READ_CHUNK_SIZE, self._on_recv, partial=True)
+
+	def _on_recv(self, data):
+		for packet in self._decoder.feed(data):
+			self._on_packet(packet)
+		self._stream.read_bytes(READ_CHUNK_SIZE, self._on_recv, partial=True)
+
+def send_packets(sock, packet_size):
+	packet = struct.pack('<I', packet_size) + 'x' * packet_size
+	burst = packet * BURST_SIZE
+	for i in xrange(PACKET_COUNT / BURST_SIZE):
+		sock.sendall(burst)
+
+def bench(name, receiver_class, packet_size):
+	io_loop = IOLoop()
+	io_loop.make_current()
+	reader, writer = socket.socketpair()
+	stream = IOStream(reader)
+	received = [0]
+	def on_packet(packet):
+		received[0] += 1
+		if received[0] == PACKET_COUNT:
+			io_loop.stop()
+	receiver_class(stream, on_packet)
+	sender = threading.Thread(target=send_packets, args=(writer, packet_size))
+	start_time = time.time()
+	sender.start()
+	io_loop.start()
+	elapsed = time.time() - start_time
+	sender.join()
+	stream.close()
+	writer.close()
+	io_loop.close()
+	print '%-9s size=%-5d %9.0f packets/s %6.2f us/packet' % (name, packet_size, PACKET_COUNT / elapsed, elapsed * 1000000 / PACKET_COUNT)
+
+if __name__ == "__main__":
+	for packet_size in PACKET_SIZES:
+		bench('two_read', TwoReadReceiver, packet_size)
+		bench('decoder', DecoderReceiver, packet_size)
@@ -0,0 +1,109 @@
+'''
+Task latency under each worker selection policy, simulated.
+
+A discrete event simulation drives WorkerPool the way GTcpServer does:
+tasks arrive as a poisson process, go to the idle worker the policy
+picks or wait in a shared queue, and each worker runs its in-flight
+tasks one after the other. Service times are exponential, except on
+SLOW_WORKER_COUNT workers which are SLOW_FACTOR times slower, standing
+in for a worker stuck behind a slow cache shard or in a long GC. Load is
+given as a fraction of the total capacity of the workers.
+'''
+import os
+import sys
+import heapq
+import random
+from collections import deque
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(curr_dir)
+sys.path.append(os.path.join(curr_dir, '../'))
+
+from gtcp.worker_pool import WorkerPool, WORKER_SELECTION_FIFO, WORKER_SELECTION_LIFO, WORKER_SELECTION_LEAST_OUTSTANDING, WORKER_SELECTION_EWMA_P2C
+
+WORKER_COUNT = 16
+SLOW_WORKER_COUNT = 2
+SLOW_FACTOR = 8
+MAX_INFLIGHT = 2
+SERVICE_TIME = 0.001
+TASK_COUNT = 200000
+LOADS = [0.5, 0.8, 0.9]
+SELECTIONS = [WORKER_SELECTION_FIFO, WORKER_SELECTION_LIFO, WORKER_SELECTION_LEAST_OUTSTANDING, WORKER_SELECTION_EWMA_P2C]
+
+class SimWorker(object):
+
+	def __init__(self, worker_id, mean_service_time):
+		self.worker_id = worker_id
+		self.suspect = False
+		self.inflight_frames = 0
+		self.service_time_ewma = None
+		self.mean_service_time = mean_service_time
+		self.tasks = deque()
+		self.busy_until = 0
+
+def percentile(sorted_values, fraction):
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def simulate(selection, load, seed):
+	random.seed(seed)
+	pool = WorkerPool('sim', selection)
+	workers = []
+	for i in xrange(WORKER_COUNT):
+		factor = SLOW_FACTOR if i < SLOW_WORKER_COUNT else 1
+		worker = SimWorker(i, SERVICE_TIME * factor)
+		workers.append(worker)
+		pool.add(worker)
+		pool.put_idle(worker)
+	capacity = sum(1.0 / worker.mean_service_time for worker in workers)
+	arrival_rate = capacity * load
+	waiting = deque()
+	events = []
+	latencies = []
+	now = 0
+
+	def assign(worker, arrival_time):
+		worker.inflight_frames += 1
+		worker.tasks.append(arrival_time)
+		if len(worker.tasks) == 1:
+			start(worker)
+
+	def start(worker):
+		service_time = random.expovariate(1.0 / worker.mean_service_time)
+		worker.busy_until = now + service_time
+		heapq.heappush(events, (worker.busy_until, 1, worker.worker_id, service_time))
+
+	next_arrival = random.expovariate(arrival_rate)
+	arrivals = 0
+	while arrivals < TASK_COUNT or events:
+		if arrivals < TASK_COUNT and (not events or next_arrival < events[0][0]):
+			now = next_arrival
+			arrivals += 1
+			next_arrival = now + random.expovariate(arrival_rate)
+			if pool.has_idle():
+				worker = pool.get_idle()
+				assign(worker, now)
+				if worker.inflight_frames < MAX_INFLIGHT:
+					pool.put_idle(worker)
+			else:
+				waiting.append(now)
+			continue
+		now, _, worker_id, service_time = heapq.heappop(events)
+		worker = workers[worker_id]
+		latencies.append(now - worker.tasks.popleft())
+		worker.inflight_frames -= 1
+		pool.observe_service_time(worker, service_time)
+		if worker.tasks:
+			start(worker)
+		while worker.inflight_frames < MAX_INFLIGHT and waiting:
+			assign(worker, waiting.popleft())
+		if worker.inflight_frames < MAX_INFLIGHT:
+			pool.put_idle(worker)
+	latencies.sort()
+	return percentile(latencies, 0.5), percentile(latencies, 0.99), percentile(latencies, 0.999)
+
+if __name__ == "__main__":
+	print 'workers=%d slow=%d x%d max_inflight=%d service_time=%.1fms tasks=%d' % (WORKER_COUNT, SLOW_WORKER_COUNT, SLOW_FACTOR, MAX_INFLIGHT, SERVICE_TIME * 1000, TASK_COUNT)
+	for load in LOADS:
+		for selection in SELECTIONS:
+			p50, p99, p999 = simulate(selection, load, 1)
+			print 'load=%.1f %-17s p50=%7.2fms p99=%7.2fms p99.9=%7.2fms' % (load, selection, p50 * 1000, p99 * 1000, p999 * 1000)
@@ -0,0 +1,111 @@
+'''
+Throughput and memory of I/O bound workers run as processes or as threads.
+
+A GTcpServer runs in a child process with a Processor that waits IO_TIME
+on every request, standing in for a cache round trip, and burns CPU_TIME
+on top. Client processes keep CLIENT_COUNT blocking requests in flight
+for DURATION seconds. Every layout is given per core: more worker
+processes with one thread each, or one process per core with a pool of
+WORKER_THREAD_COUNT threads. The rss column sums the resident memory of
+the worker processes.
+'''
+import os
+import sys
+import time
+import signal
+import resource
+from multiprocessing import Process, Queue, cpu_count
+from threading import Thread
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(curr_dir)
+sys.path.append(os.path.join(curr_dir, '../'))
+
+from gtcp.gtcpclient import GTcpClient
+from gtcp import tcp_server
+
+LISTEN_ENDPOINT = {'address': '127.0.0.1', 'port': 18861}
+WORK_ENDPOINT = {'path': '/tmp/gtcp_bench_threads.sock'}
+IO_TIME = 0.005
+CPU_TIME = 0.0002
+DURATION = 5
+CLIENT_PROCESSES = 4
+CLIENT_COUNT = 128
+# (processes per core, threads per process)
+LAYOUTS = [(1, 1), (4, 1), (16, 1), (1, 4), (1, 16), (4, 4)]
+
+class BenchConfig(object):
+	DEBUG = False
+	LISTEN_ENDPOINTS = [LISTEN_ENDPOINT]
+	WORK_ENDPOINT = WORK_ENDPOINT
+	CONNECTION_ID_RANDOM_PADDING = False
+	ENABLE_KEEP_ALIVE = False
+	TCP_MAX_PACKET_SIZE = 262144
+	STATS_LOG_INTERVAL = 0
+
+class BenchProcessor(tcp_server.Processor):
+
+	def on_packet(self, client, request):
+		time.sleep(IO_TIME)
+		deadline = time.time() + CPU_TIME
+		while time.time() < deadline:
+			pass
+		return request
+
+def get_rss(pid):
+	try:
+		with open('/proc/%d/statm' % pid) as f:
+			return int(f.read().split()[1]) * resource.getpagesize()
+	except IOError:
+		return 0
+
+def run_server(worker_count, thread_count, pid_queue):
+	config = type('Config', (BenchConfig,), dict(WORKER_COUNT=worker_count, WORKER_THREAD_COUNT=thread_count, WORKER_MAX_INFLIGHT=thread_count))
+	server = tcp_server.GTcpServer(config, BenchProcessor)
+	pid_queue.put([p.pid for p in server._worker_processes.values()])
+	tcp_server.run()
+
+def run_clients(thread_count, result_queue):
+	counts = [0] * thread_count
+	deadline = time.time() + DURATION
+	def run_client(index):
+		client = GTcpClient(LISTEN_ENDPOINT['address'], LISTEN_ENDPOINT['port'], 10)
+		while time.time() < deadline:
+			if client.request('x' * 64) is not None:
+				counts[index] += 1
+		client.close()
+	threads = [Thread(target=run_client, args=(i,)) for i in xrange(thread_count)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	result_queue.put(sum(counts))
+
+def bench(cores, processes_per_core, thread_count):
+	worker_count = cores * processes_per_core
+	pid_queue = Queue()
+	server = Process(target=run_server, args=(worker_count, thread_count, pid_queue))
+	server.start()
+	worker_pids = pid_queue.get()
+	time.sleep(1)
+	result_queue = Queue()
+	clients = [Process(target=run_clients, args=(CLIENT_COUNT / CLIENT_PROCESSES, result_queue)) for i in xrange(CLIENT_PROCESSES)]
+	for client in clients:
+		client.start()
+	request_count = sum(result_queue.get() for client in clients)
+	for client in clients:
+		client.join()
+	rss = sum(get_rss(pid) for pid in worker_pids)
+	# workers reconnect forever once their gateway is gone, so they are killed first
+	for pid in worker_pids:
+		os.kill(pid, signal.SIGKILL)
+	server.terminate()
+	server.join()
+	print 'processes=%-3d threads=%-3d concurrency=%-4d %8.0f req/s %7.1f MB rss' % (worker_count, thread_count,
+		worker_count * thread_count, request_count / float(DURATION), rss / 1048576.0)
+
+if __name__ == "__main__":
+	cores = cpu_count()
+	print 'cores=%d io_time=%.1fms cpu_time=%.1fms clients=%d' % (cores, IO_TIME * 1000, CPU_TIME * 1000, CLIENT_COUNT)
+	for processes_per_core, thread_count in LAYOUTS:
+		bench(cores, processes_per_core, thread_count)
@@ -0,0 +1,61 @@
+'''
+Round trip cost of the gateway <-> worker hop over tcp loopback and unix sockets.
+
+A child process runs a gateway style echo server (CallbackTcpServer + GTcpConnection)
+and the parent drives it with the blocking GTcpClient used by Processor workers.
+'''
+import os
+import sys
+import time
+from multiprocessing import Process
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(curr_dir)
+sys.path.append(os.path.join(curr_dir, '../'))
+
+from gtcp.gtcpclient import GTcpClient
+from gtcp import tcp_server
+
+TCP_ENDPOINT = {'address': '127.0.0.1', 'port': 18851}
+UNIX_ENDPOINT = {'path': '/tmp/gtcp_bench_worker.sock'}
+REQUEST_COUNT = 20000
+PACKET_SIZES = [64, 200, 1024, 16384]
+
+class BenchConfig(object):
+	CONNECTION_ID_RANDOM_PADDING = False
+	ENABLE_KEEP_ALIVE = True
+	KEEP_ALIVE_OPT = {'timeout': 30, 'interval': 5, 'count': 5}
+	TCP_MAX_PACKET_SIZE = 262144
+
+def run_echo_server(endpoint):
+	def on_connect(stream, address):
+		tcp_server.GTcpConnection(stream, address, BenchConfig, on_packet=lambda conn, data: conn.send_packet(data))
+	server = tcp_server.CallbackTcpServer(on_connect=on_connect)
+	server.listen_endpoint(**endpoint)
+	tcp_server.run()
+
+def connect(endpoint):
+	if 'path' in endpoint:
+		return GTcpClient(endpoint['path'], None, 0)
+	return GTcpClient(endpoint['address'], endpoint['port'], 0)
+
+def bench(name, endpoint):
+	server = Process(target=run_echo_server, args=(endpoint,))
+	server.daemon = True
+	server.start()
+	time.sleep(0.5)
+	client = connect(endpoint)
+	for packet_size in PACKET_SIZES:
+		packet = 'x' * packet_size
+		client.request(packet)
+		start_time = time.time()
+		for i in xrange(REQUEST_COUNT):
+			client.request(packet)
+		elapsed = time.time() - start_time
+		print '%-5s size=%-6d %8.0f req/s %8.1f us/rtt' % (name, packet_size, REQUEST_COUNT / elapsed, elapsed * 1000000 / REQUEST_COUNT)
+	client.close()
+	server.terminate()
+
+if __name__ == "__main__":
+	bench('tcp', TCP_ENDPOINT)
+	bench('unix', UNIX_ENDPOINT)
@@ -0,0 +1,130 @@
+'''
+Processor whose worker runs an IOLoop and handles many tasks at once.
+
+on_packet, on_client_connect and on_client_disconnect may return a
+Future, typically by being a tornado gen.coroutine, and the worker reads
+the next task while one waits on I/O. Handlers returning a plain value
+run as they do under Processor, so synchronous subclasses keep working.
+
+The gateway matches every reply with the oldest task it has in flight on
+the worker, so replies go through a ReorderBuffer and leave in the order
+their tasks came in. How many frames a worker gets at once is bounded by
+WORKER_MAX_INFLIGHT on the gateway, which has to be raised above 1 for
+tasks to overlap. The worker says so in its hello, and if it goes away
+the gateway closes the clients of its tasks in flight instead of running
+them again on another worker.
+'''
+import random
+from functools import partial
+from tornado import gen
+from logger import log
+from tcp_server import Processor, TcpEndpoint, pack_batches, unpack_batch, max_task_frame_size
+from tcp_server import GTCP_CMD_SIZE, GTCP_HEADER_SIZE
+from tcp_server import GTCP_CMD_RELAY, GTCP_CMD_BATCH, GTCP_CMD_CONNECT, GTCP_CMD_DISCONNECT
+from reorder_buffer import ReorderBuffer
+import event_loop
+
+class AsyncProcessor(Processor):
+
+	def __init__(self, id, config):
+		Processor.__init__(self, id, config)
+		self._replies = ReorderBuffer()
+
+	def run(self):
+		random.seed()
+		event_loop.create()
+		self.on_init()
+		log.info('tcp_worker_start|id=%d,mode=async', self._id)
+		endpoint = self._work_endpoint
+		if self._shm_channel is not None:
+			from shm_ring import ShmRingAsyncClient
+			if not self._config.DEBUG:
+				self._shm_channel.close_gateway_end()
+			self._client = ShmRingAsyncClient(self._shm_channel, getattr(self._config, 'SHM_POLL_INTERVAL', 0.01), self._on_request, on_connect=self._on_connect)
+		else:
+			from gtcpasyncclient import GTcpAsyncClient
+			if 'path' in endpoint:
+				address, port = endpoint['path'], None
+			else:
+				address, port = endpoint['address'], endpoint['port']
+			self._client = GTcpAsyncClient('worker_%u' % self._id, address, port, self._on_request, on_connect=self._on_connect, on_disconnect=self._on_disconnect,
+				max_packet_size=max_task_frame_size(self._config))
+		event_loop.run()
+
+	def _runs_concurrently(self):
+		return True
+
+	def _on_connect(self, client):
+		# replies owed on an earlier connection are dropped, the gateway closed the clients of their tasks
+		self._replies = ReorderBuffer()
+		Processor._on_connect(self, client)
+
+	def _on_disconnect(self, client):
+		log.warn('tcp_worker_lost_connection|id=%u,pending=%u', self._id, self._replies.pending_count())
+		self._replies = ReorderBuffer()
+
+	def _on_request(self, client, request):
+		if len(request) < GTCP_HEADER_SIZE:
+			log.error('tcp_worker_request_packet_error|id=%u,request=%s', self._id, request.encode('hex'))
+			client.close()
+			return
+		if request[:GTCP_CMD_SIZE] == GTCP_CMD_BATCH:
+			requests = unpack_batch(request)
+			if requests is None:
+				log.error('tcp_worker_batch_error|id=%u,request=%s', self._id, request.encode('hex'))
+				client.close()
+				return
+		else:
+			requests = None
+		replies = self._replies
+		seq = replies.reserve()
+		if requests is None:
+			future = self._handle_request(request)
+		else:
+			future = self._handle_batch(requests)
+		future.add_done_callback(partial(self._on_request_done, replies, seq, requests is not None))
+
+	def _on_request_done(self, replies, seq, batch, future):
+		if replies is not self._replies:
+			return
+		try:
+			frames = future.result()
+		except Exception as ex:
+			log.exception('tcp_worker_exception|id=%u,exception=%s', self._id, ex)
+			self._client.close()
+			return
+		if not batch:
+			frames = (frames,)
+		for frames in replies.put(seq, frames):
+			for frame in frames:
+				self._client.send(frame)
+
+	@gen.coroutine
+	def _handle_request(self, request):
+		request_cmd = request[:GTCP_CMD_SIZE]
+		request_client = TcpEndpoint(request[GTCP_CMD_SIZE:GTCP_HEADER_SIZE])
+		reply_body = None
+		try:
+			if request_cmd == GTCP_CMD_RELAY:
+				reply_body = yield gen.maybe_future(self.on_packet(request_client, request[GTCP_HEADER_SIZE:]))
+			elif request_cmd == GTCP_CMD_CONNECT:
+				reply_body = yield gen.maybe_future(self.on_client_connect(request_client))
+			elif request_cmd == GTCP_CMD_DISCONNECT:
+				yield gen.maybe_future(self.on_client_disconnect(request_client))
+		except Exception as ex:
+			# other tasks share the connection, so the failed one is answered with no reply instead of a reconnect
+			log.exception('tcp_worker_exception|id=%u,exception=%s', self._id, ex)
+			reply_body = None
+		raise gen.Return(self._reply_frame(request_client, reply_body))
+
+	@gen.coroutine
+	def _handle_batch(self, requests):
+		futures = []
+		for sub_request in requests:
+			if len(sub_request) < GTCP_HEADER_SIZE:
+				log.error('tcp_worker_request_packet_error|id=%u,request=%s', self._id, sub_request.encode('hex'))
+				futures.append(gen.maybe_future(self._none_frame(sub_request)))
+			else:
+				futures.append(self._handle_request(sub_request))
+		replies = yield futures
+		raise gen.Return(pack_batches(replies, self._max_reply_size))
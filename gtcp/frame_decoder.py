@@ -0,0 +1,91 @@
+'''
+Incremental decoder for '<I' length prefixed frames.
+
+Connections read whatever bytes are available and feed them here,
+getting back every frame completed by them in one pass, instead of
+issuing one read for the header and another for the body of each packet.
+'''
+import struct
+
+FRAME_HEADER_SIZE = 4
+
+_frame_header_struct = struct.Struct('<I')
+
+class FrameDecoder(object):
+
+	__slots__ = ('_max_frame_size', '_chunks', '_buffered_size', '_wanted_size', '_error', '_frame_size')
+
+	def __init__(self, max_frame_size=None):
+		'''
+		frames of max_frame_size bytes or more set error, nothing is decoded after them
+		'''
+		self._max_frame_size = max_frame_size
+		# only allocated while a partial frame is buffered, most connections sit idle without one
+		self._chunks = None
+		self._buffered_size = 0
+		# bytes needed before the buffered chunks are worth joining
+		self._wanted_size = FRAME_HEADER_SIZE
+		self._error = False
+		self._frame_size = 0
+
+	@property
+	def error(self):
+		return self._error
+
+	@property
+	def frame_size(self):
+		'''
+		size announced by the last frame header decoded
+		'''
+		return self._frame_size
+
+	def buffered_size(self):
+		return self._buffered_size
+
+	def reset(self):
+		self._chunks = None
+		self._buffered_size = 0
+		self._wanted_size = FRAME_HEADER_SIZE
+		self._error = False
+		self._frame_size = 0
+
+	def feed(self, data):
+		if self._error:
+			return []
+		self._buffered_size += len(data)
+		if self._buffered_size < self._wanted_size:
+			if self._chunks is None:
+				self._chunks = [data]
+			else:
+				self._chunks.append(data)
+			return []
+		if self._chunks is not None:
+			self._chunks.append(data)
+			data = ''.join(self._chunks)
+			self._chunks = None
+		frames = []
+		offset = 0
+		data_size = len(data)
+		while data_size - offset >= FRAME_HEADER_SIZE:
+			(frame_size,) = _frame_header_struct.unpack_from(data, offset)
+			self._frame_size = frame_size
+			if self._max_frame_size is not None and frame_size >= self._max_frame_size:
+				self._error = True
+				self._buffered_size = 0
+				return frames
+			frame_end = offset + FRAME_HEADER_SIZE + frame_size
+			if frame_end > data_size:
+				break
+			frames.append(data[offset + FRAME_HEADER_SIZE:frame_end])
+			offset = frame_end
+		if offset < data_size:
+			self._chunks = [data[offset:] if offset else data]
+			self._buffered_size = data_size - offset
+			if self._buffered_size >= FRAME_HEADER_SIZE:
+				self._wanted_size = FRAME_HEADER_SIZE + self._frame_size
+			else:
+				self._wanted_size = FRAME_HEADER_SIZE
+		else:
+			self._buffered_size = 0
+			self._wanted_size = FRAME_HEADER_SIZE
+		return frames
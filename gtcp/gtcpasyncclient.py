@@ -1,16 +1,22 @@
 from tornado.tcpclient import TCPClient
+from tornado.iostream import IOStream
 import socket
 import platform
 import struct
 from logger import log
 import event_loop
+from frame_decoder import FrameDecoder
 
 class GTcpAsyncClient(object):
 
-	HEADER_SIZE = 4
+	READ_CHUNK_SIZE = 65536
 	TCP_MAX_PACKET_SIZE = 256 * 1024
 
-	def __init__(self, id, address, port, on_receive_packet, on_connect=None, on_disconnect=None):
+	def __init__(self, id, address, port, on_receive_packet, on_connect=None, on_disconnect=None, max_packet_size=None):
+		'''
+		address is a unix socket path when port is None
+		the connection is dropped when a packet of more than max_packet_size bytes, TCP_MAX_PACKET_SIZE by default, comes in
+		'''
 		self._id = id
 		self._address = address
 		self._port = port
@@ -19,6 +25,7 @@ class GTcpAsyncClient(object):
 		self._on_disconnect_callback = on_disconnect
 		self._stream = None
 		self._pending_buffer = []
+		self._decoder = FrameDecoder((max_packet_size or self.TCP_MAX_PACKET_SIZE) + 1)
 		self._async_connect()
 
 	@property
@@ -32,6 +39,7 @@ class GTcpAsyncClient(object):
 		else:
 			self._pending_buffer.append(packet_length)
 			self._pending_buffer.append(packet)
+		return True
 
 	def close(self):
 		event_loop.add_callback(self._close)
@@ -41,7 +49,10 @@ class GTcpAsyncClient(object):
 
 	def _async_connect(self):
 		log.info('tcp_asnyc_client_try_connect|id=%s,address=%s,port=%s', self._id, self._address, self._port)
-		TCPClient().connect(self._address, self._port).add_done_callback(self._on_connect)
+		if self._port is None:
+			IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)).connect(self._address).add_done_callback(self._on_connect)
+		else:
+			TCPClient().connect(self._address, self._port).add_done_callback(self._on_connect)
 
 	def _on_connect(self, future):
 		try:
@@ -53,7 +64,8 @@ class GTcpAsyncClient(object):
 			return
 		log.info('tcp_asnyc_client_connect|id=%s,address=%s,port=%s', self._id, self._address, self._port)
 		self._stream.set_close_callback(self._on_close)
-		self._set_keep_alive()
+		if self._port is not None:
+			self._set_keep_alive()
 		if self._on_connect_callback is not None:
 			try:
 				self._on_connect_callback(self)
@@ -62,7 +74,8 @@ class GTcpAsyncClient(object):
 		if self._pending_buffer:
 			self._stream.write(''.join(self._pending_buffer))
 			self._pending_buffer = []
-		self._recv_header()
+		self._decoder.reset()
+		self._recv()
 
 	def _close(self):
 		if self._stream:
@@ -70,6 +83,8 @@ class GTcpAsyncClient(object):
 			self._stream = None
 
 	def _on_close(self):
+		# frames sent until the reconnect wait in the pending buffer instead of hitting the closed stream
+		self._stream = None
 		log.info('tcp_asnyc_client_disconnect|id=%s,address=%s,port=%s', self._id, self._address, self._port)
 		if self._on_disconnect_callback is not None:
 			try:
@@ -78,24 +93,24 @@ class GTcpAsyncClient(object):
 				log.exception('tcp_asnyc_client_on_disconnect_exception|id=%s,address=%s,port=%s', self._id, self._address, self._port)
 		self._async_connect()
 
-	def _recv_header(self):
-		self._stream.read_bytes(self.HEADER_SIZE, self._on_recv_header)
+	def _recv(self):
+		self._stream.read_bytes(self.READ_CHUNK_SIZE, self._on_recv, partial=True)
 
-	def _on_recv_header(self, data):
-		(body_size,) = struct.unpack('<I', data)
-		if body_size > self.TCP_MAX_PACKET_SIZE:
-			log.error('tcp_asnyc_client_body_size_overflow|id=%s,size=%u', self._id, body_size)
+	def _on_recv(self, data):
+		stream = self._stream
+		for packet in self._decoder.feed(data):
+			if self._on_receive_packet_callback is not None:
+				try:
+					self._on_receive_packet_callback(self, packet)
+				except:
+					log.exception('tcp_asnyc_client_on_receive_exception|id=%s,packet=%s', self._id, packet.encode('hex'))
+			if self._stream is not stream:
+				return
+		if self._decoder.error:
+			log.error('tcp_asnyc_client_body_size_overflow|id=%s,size=%u', self._id, self._decoder.frame_size)
 			self._close()
 			return
-		self._stream.read_bytes(body_size, self._on_recv_body)
-
-	def _on_recv_body(self, data):
-		if self._on_receive_packet_callback is not None:
-			try:
-				self._on_receive_packet_callback(self, data)
-			except:
-				log.exception('tcp_asnyc_client_on_receive_exception|id=%s,packet=%s', self._id, data.encode('hex'))
-		self._recv_header()
+		self._recv()
 
 	def _set_keep_alive(self):
 		stream_socket = self._stream.socket
@@ -2,21 +2,43 @@ import socket
 import struct
 import json
 import platform
+from collections import deque
 from logger import log
+from frame_decoder import FrameDecoder
 
 class GTcpClient(object):
 
-	def __init__(self, address, port, timeout=10, retry=True):
+	RECV_CHUNK_SIZE = 65536
+
+	def __init__(self, address, port, timeout=10, retry=True, on_connect=None):
+		'''
+		address is a unix socket path when port is None
+		'''
 		self._address = address
-		self._port = port
+		self._unix = port is None
+		self._port = port or 0
 		self._socket = None
 		self._timeout = timeout
 		self._retry = retry
+		self._on_connect_callback = on_connect
+		self._decoder = FrameDecoder()
+		self._packets = deque()
+
+	def connect(self):
+		if self._socket is None:
+			return self._connect()
+		return True
+
+	def connected(self):
+		return self._socket is not None
 
 	def close(self):
 		if self._socket is not None:
 			self._socket.close()
 			self._socket = None
+		# whatever was read ahead belongs to the closed connection
+		self._decoder.reset()
+		self._packets.clear()
 			
 	def send(self, request):
 		if self._socket is None:
@@ -48,14 +70,19 @@ class GTcpClient(object):
 			if not self._connect():
 				return None
 		try:
-			length_data = self._recv(4)
-			length = struct.unpack('<I', length_data)[0]
-			return self._recv(length)
+			return self._recv_packet()
 		except Exception as ex:
 			log.warn('tcp_recv_fail|address=%s,port=%u,ex=%s', self._address, self._port, ex, exc_info=True)
 			self.close()
 			return None
 
+	def read_packet(self):
+		'''
+		reads the next packet of the connection and raises when that fails, without closing or reconnecting,
+		for a caller sharing the client between threads that manages the connection itself
+		'''
+		return self._recv_packet()
+
 	def request(self, request):
 		if self._socket is None:
 			if not self._connect():
@@ -63,7 +90,7 @@ class GTcpClient(object):
 		packet = struct.pack('<I%ds' % len(request), len(request), request)
 		try:
 			self._socket.sendall(packet)
-			length_data = self._recv(4)
+			return self._recv_packet()
 		except Exception as ex:
 			self.close()
 			if not self._retry:
@@ -78,18 +105,11 @@ class GTcpClient(object):
 				return None
 			try:
 				self._socket.sendall(packet)
-				length_data = self._recv(4)
+				return self._recv_packet()
 			except Exception as ex:
 				log.exception('tcp_request_fail|error=retry_recv_length_fail,address=%s,port=%u,retry=1,request=%s', self._address, self._port, request.encode('hex'))
 				self.close()
 				return None
-		try:
-			length = struct.unpack('<I', length_data)[0]
-			return self._recv(length)
-		except Exception as ex:
-			log.exception('tcp_request_fail|error=recv_data_fail,address=%s,port=%u,request=%s', self._address, self._port, request.encode('hex'))
-			self.close()
-			return None
 
 	def request_json(self, request):
 		request_data = json.dumps(request)
@@ -105,28 +125,36 @@ class GTcpClient(object):
 
 	def _connect(self):
 		try:
-			self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			if self._unix:
+				self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			else:
+				self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				self._set_keep_alive()
 			if self._timeout > 0:
 				self._socket.settimeout(self._timeout)
-			self._set_keep_alive()
-			self._socket.connect((self._address, self._port))
+			if self._unix:
+				self._socket.connect(self._address)
+			else:
+				self._socket.connect((self._address, self._port))
 			log.info('tcp_connect|address=%s,port=%u', self._address, self._port)
-			return True
 		except Exception as ex:
 			log.exception('tcp_connect_fail|address=%s,port=%u,ex=%s', self._address, self._port, ex)
 			self.close()
 			return False
+		if self._on_connect_callback is not None:
+			try:
+				self._on_connect_callback(self)
+			except:
+				log.exception('tcp_on_connect_exception|address=%s,port=%u', self._address, self._port)
+		return self._socket is not None
 
-	def _recv(self, length):
-		data = ''
-		while length > 0:
-			recv_data = self._socket.recv(length)
-			recv_length = len(recv_data)
-			if recv_length <= 0:
+	def _recv_packet(self):
+		while not self._packets:
+			recv_data = self._socket.recv(self.RECV_CHUNK_SIZE)
+			if len(recv_data) <= 0:
 				raise Exception('socket_closed')
-			data += recv_data
-			length -= recv_length
-		return data
+			self._packets.extend(self._decoder.feed(recv_data))
+		return self._packets.popleft()
 
 	def _set_keep_alive(self):
 		self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
@@ -0,0 +1,38 @@
+'''
+Puts results that complete out of order back in the order their work
+was started in.
+
+reserve() hands out increasing sequence numbers when work starts, put()
+stores the result of one and returns every result that is now next in
+line, oldest first. Results ahead of a slow one wait in a dict keyed by
+sequence number, so each result is stored and released in O(1).
+'''
+
+class ReorderBuffer(object):
+
+	def __init__(self):
+		self._next_seq = 0
+		self._release_seq = 0
+		self._done = {}
+
+	def reserve(self):
+		seq = self._next_seq
+		self._next_seq += 1
+		return seq
+
+	def put(self, seq, result):
+		if seq != self._release_seq:
+			self._done[seq] = result
+			return ()
+		results = [result]
+		self._release_seq += 1
+		while self._release_seq in self._done:
+			results.append(self._done.pop(self._release_seq))
+			self._release_seq += 1
+		return results
+
+	def pending_count(self):
+		'''
+		work started and not released yet
+		'''
+		return self._next_seq - self._release_seq
@@ -0,0 +1,367 @@
+'''
+Shared memory transport between GTcpServer and its Processor workers.
+
+Every worker gets a ShmChannel created before it is forked: two single
+producer / single consumer rings in anonymous shared mmaps, one for tasks
+and one for replies, carrying the usual cmd + client_id + body frames.
+A pipe per ring is the doorbell. The producer only rings it when the
+consumer has flagged that it is going to sleep, so a busy pair exchanges
+frames without syscalls. The flag is not fenced, so both sides also poll
+on a short interval and a missed wakeup only costs latency.
+
+Offsets are published after the data is written, which relies on the
+store ordering of x86. GTcpServer refuses the transport on any machine
+not listed in SHM_MACHINES.
+'''
+import os
+import sys
+import time
+import errno
+import fcntl
+import mmap
+import select
+import struct
+from collections import deque
+from tornado.ioloop import IOLoop, PeriodicCallback
+from logger import log
+
+SHM_MACHINES = ('x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86')
+RING_HEADER_SIZE = 64
+RING_HEAD_OFFSET = 0
+RING_TAIL_OFFSET = 8
+RING_WAITING_OFFSET = 16
+FRAME_HEADER_SIZE = 4
+
+_offset_struct = struct.Struct('<Q')
+_frame_header_struct = struct.Struct('<I')
+
+def max_frame_size(ring_size):
+	'''
+	biggest frame a ring of ring_size bytes can ever hold
+	'''
+	return ring_size - FRAME_HEADER_SIZE
+
+def _set_nonblocking(fd):
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+	fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _exit_frame_too_large(size, max_size):
+	# a worker has no other way to the gateway, which closes the clients of its tasks once it is gone
+	log.error('shm_frame_too_large|pid=%s,size=%u,max=%u', os.getpid(), size, max_size)
+	sys.exit(1)
+
+class ShmRing(object):
+
+	def __init__(self, size):
+		self._size = size
+		self.max_frame_size = max_frame_size(size)
+		self._mm = mmap.mmap(-1, RING_HEADER_SIZE + size)
+		# producer and consumer each keep their own offset locally, the shared copy is for the other side
+		self._head = 0
+		self._tail = 0
+		self.doorbell_r, self.doorbell_w = os.pipe()
+		_set_nonblocking(self.doorbell_r)
+		_set_nonblocking(self.doorbell_w)
+
+	def put(self, frame):
+		'''
+		returns False while the consumer has not made room yet, a frame over max_frame_size never fits
+		'''
+		record_size = FRAME_HEADER_SIZE + len(frame)
+		(head,) = _offset_struct.unpack_from(self._mm, RING_HEAD_OFFSET)
+		if record_size > self._size - (self._tail - head):
+			return False
+		self._write(self._tail, _frame_header_struct.pack(len(frame)))
+		self._write(self._tail + FRAME_HEADER_SIZE, frame)
+		self._tail += record_size
+		_offset_struct.pack_into(self._mm, RING_TAIL_OFFSET, self._tail)
+		if self._mm[RING_WAITING_OFFSET] != '\0':
+			self.ring()
+		return True
+
+	def get(self):
+		(tail,) = _offset_struct.unpack_from(self._mm, RING_TAIL_OFFSET)
+		if tail == self._head:
+			return None
+		(frame_size,) = _frame_header_struct.unpack(self._read(self._head, FRAME_HEADER_SIZE))
+		frame = self._read(self._head + FRAME_HEADER_SIZE, frame_size)
+		self._head += FRAME_HEADER_SIZE + frame_size
+		_offset_struct.pack_into(self._mm, RING_HEAD_OFFSET, self._head)
+		return frame
+
+	def set_waiting(self, waiting):
+		self._mm[RING_WAITING_OFFSET] = '\1' if waiting else '\0'
+
+	def ring(self):
+		try:
+			os.write(self.doorbell_w, '\0')
+		except OSError as ex:
+			# a full pipe already wakes the consumer, a closed one means it is gone
+			if ex.errno not in (errno.EAGAIN, errno.EPIPE):
+				raise
+
+	def drain_doorbell(self):
+		'''
+		returns False once every producer side of the doorbell is closed
+		'''
+		while True:
+			try:
+				data = os.read(self.doorbell_r, 4096)
+			except OSError as ex:
+				if ex.errno == errno.EAGAIN:
+					return True
+				raise
+			if not data:
+				return False
+
+	def close(self):
+		for fd in (self.doorbell_r, self.doorbell_w):
+			if fd is not None:
+				try:
+					os.close(fd)
+				except OSError:
+					pass
+		self.doorbell_r = self.doorbell_w = None
+		self._mm.close()
+
+	def _write(self, offset, data):
+		pos = offset % self._size
+		first = min(len(data), self._size - pos)
+		start = RING_HEADER_SIZE + pos
+		self._mm[start:start + first] = data[:first]
+		if first < len(data):
+			self._mm[RING_HEADER_SIZE:RING_HEADER_SIZE + len(data) - first] = data[first:]
+
+	def _read(self, offset, size):
+		pos = offset % self._size
+		first = min(size, self._size - pos)
+		start = RING_HEADER_SIZE + pos
+		data = self._mm[start:start + first]
+		if first < size:
+			data += self._mm[RING_HEADER_SIZE:RING_HEADER_SIZE + size - first]
+		return data
+
+class ShmChannel(object):
+
+	def __init__(self, ring_size):
+		self.task_ring = ShmRing(ring_size)
+		self.reply_ring = ShmRing(ring_size)
+
+	def close_worker_end(self):
+		'''
+		called by the gateway once the worker is forked
+		'''
+		os.close(self.task_ring.doorbell_r)
+		os.close(self.reply_ring.doorbell_w)
+		self.task_ring.doorbell_r = None
+		self.reply_ring.doorbell_w = None
+
+	def close_gateway_end(self):
+		'''
+		called by the worker after fork
+		'''
+		os.close(self.task_ring.doorbell_w)
+		os.close(self.reply_ring.doorbell_r)
+		self.task_ring.doorbell_w = None
+		self.reply_ring.doorbell_r = None
+
+	def close(self):
+		self.task_ring.close()
+		self.reply_ring.close()
+
+class ShmWorkerConnection(object):
+	'''
+	gateway side of a channel, used by GTcpServer in place of a worker GTcpConnection
+	'''
+
+	def __init__(self, channel, worker_index, poll_interval, on_packet=None, on_close=None):
+		self._channel = channel
+		self._id = '\0' * 16 + struct.pack('!HH', worker_index & 0xffff, os.getpid() & 0xffff)
+		self._remote_address = 'shm:%d' % worker_index
+		self._on_packet_callback = on_packet
+		self._on_close_callback = on_close
+		self._pending_packets = deque()
+		self._closed = False
+		self._io_loop = IOLoop.current()
+		self._io_loop.add_handler(channel.reply_ring.doorbell_r, self._on_doorbell, IOLoop.READ)
+		self._poll_timer = PeriodicCallback(self.poll, poll_interval * 1000, self._io_loop)
+		self._poll_timer.start()
+		channel.reply_ring.set_waiting(True)
+
+	@property
+	def id(self):
+		return self._id
+
+	@property
+	def remote_address(self):
+		return self._remote_address
+
+	def closed(self):
+		return self._closed
+
+	def send_packet(self, packet):
+		if self._closed:
+			return
+		if len(packet) > self._channel.task_ring.max_frame_size:
+			log.error('shm_frame_too_large|worker=%s,size=%u,max=%u', self._remote_address, len(packet), self._channel.task_ring.max_frame_size)
+			self.close()
+			return
+		if self._pending_packets or not self._channel.task_ring.put(packet):
+			self._pending_packets.append(packet)
+
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		self._poll_timer.stop()
+		self._io_loop.remove_handler(self._channel.reply_ring.doorbell_r)
+		self._pending_packets.clear()
+		self._channel.close()
+		if self._on_close_callback is not None:
+			self._io_loop.add_callback(self._on_close_callback, self)
+
+	def poll(self):
+		reply_ring = self._channel.reply_ring
+		reply_ring.set_waiting(False)
+		while not self._closed:
+			frame = reply_ring.get()
+			if frame is None:
+				reply_ring.set_waiting(True)
+				frame = reply_ring.get()
+				if frame is None:
+					break
+				reply_ring.set_waiting(False)
+			if self._on_packet_callback is not None:
+				self._on_packet_callback(self, frame)
+		task_ring = self._channel.task_ring
+		while self._pending_packets and not self._closed and task_ring.put(self._pending_packets[0]):
+			self._pending_packets.popleft()
+
+	def _on_doorbell(self, fd, events):
+		alive = self._channel.reply_ring.drain_doorbell()
+		self.poll()
+		if not alive:
+			log.warn('shm_worker_lost|worker=%s', self._remote_address)
+			self.close()
+
+class ShmRingClient(object):
+	'''
+	worker side of a channel, used by Processor in place of GTcpClient
+	'''
+
+	def __init__(self, channel, poll_interval, on_connect=None):
+		self._channel = channel
+		self._poll_interval = poll_interval
+		self._on_connect_callback = on_connect
+		self._connected = False
+		self._parent_pid = os.getppid()
+
+	def send(self, request):
+		reply_ring = self._channel.reply_ring
+		if len(request) > reply_ring.max_frame_size:
+			_exit_frame_too_large(len(request), reply_ring.max_frame_size)
+		while not reply_ring.put(request):
+			# the gateway is behind on replies, give it time to drain the ring
+			self._check_gateway()
+			time.sleep(self._poll_interval)
+		return True
+
+	def connect(self):
+		if not self._connected:
+			self._connected = True
+			if self._on_connect_callback is not None:
+				self._on_connect_callback(self)
+		return True
+
+	def connected(self):
+		return self._connected
+
+	def read_packet(self):
+		# the ring lasts as long as the worker, there is no connection to lose
+		return self.receive()
+
+	def receive(self):
+		self.connect()
+		task_ring = self._channel.task_ring
+		while True:
+			frame = task_ring.get()
+			if frame is not None:
+				return frame
+			task_ring.set_waiting(True)
+			frame = task_ring.get()
+			if frame is None:
+				select.select([task_ring.doorbell_r], [], [], self._poll_interval)
+			task_ring.set_waiting(False)
+			if frame is not None:
+				return frame
+			if not task_ring.drain_doorbell():
+				self._exit()
+			self._check_gateway()
+
+	def close(self):
+		return
+
+	def _check_gateway(self):
+		if os.getppid() != self._parent_pid:
+			self._exit()
+
+	def _exit(self):
+		log.warn('shm_worker_gateway_lost|pid=%s', os.getpid())
+		sys.exit(0)
+
+class ShmRingAsyncClient(object):
+	'''
+	worker side of a channel for workers running an IOLoop, used by AsyncProcessor in place of GTcpAsyncClient
+	'''
+
+	def __init__(self, channel, poll_interval, on_receive_packet, on_connect=None):
+		self._channel = channel
+		self._on_receive_packet_callback = on_receive_packet
+		self._parent_pid = os.getppid()
+		self._pending_packets = deque()
+		self._io_loop = IOLoop.current()
+		self._io_loop.add_handler(channel.task_ring.doorbell_r, self._on_doorbell, IOLoop.READ)
+		self._poll_timer = PeriodicCallback(self.poll, poll_interval * 1000, self._io_loop)
+		self._poll_timer.start()
+		channel.task_ring.set_waiting(True)
+		if on_connect is not None:
+			on_connect(self)
+
+	def send(self, request):
+		if len(request) > self._channel.reply_ring.max_frame_size:
+			_exit_frame_too_large(len(request), self._channel.reply_ring.max_frame_size)
+		if self._pending_packets or not self._channel.reply_ring.put(request):
+			# the gateway is behind on replies, the poll timer retries once it drained the ring
+			self._pending_packets.append(request)
+		return True
+
+	def close(self):
+		return
+
+	def poll(self):
+		reply_ring = self._channel.reply_ring
+		while self._pending_packets and reply_ring.put(self._pending_packets[0]):
+			self._pending_packets.popleft()
+		task_ring = self._channel.task_ring
+		task_ring.set_waiting(False)
+		while True:
+			frame = task_ring.get()
+			if frame is None:
+				task_ring.set_waiting(True)
+				frame = task_ring.get()
+				if frame is None:
+					break
+				task_ring.set_waiting(False)
+			self._on_receive_packet_callback(self, frame)
+		if os.getppid() != self._parent_pid:
+			self._exit()
+
+	def _on_doorbell(self, fd, events):
+		alive = self._channel.task_ring.drain_doorbell()
+		self.poll()
+		if not alive:
+			self._exit()
+
+	def _exit(self):
+		log.warn('shm_worker_gateway_lost|pid=%s', os.getpid())
+		sys.exit(0)
@@ -16,8 +16,10 @@ class SimpleQueue():
 
 	def get(self):
 		return self._q.popleft()
-	
-	def remove(self, value):
-		if value in self._q:
-			self._q.remove(value)
+
+	def put_back(self, item):
+		'''
+		returns an item just taken by get to the front
+		'''
+		self._q.appendleft(item)
 
@@ -0,0 +1,61 @@
+'''
+In-process counters and histograms.
+
+incr/set_value/observe are cheap enough for the packet path;
+snapshot() builds a plain dict which can be logged or served.
+'''
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+class Histogram(object):
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self._buckets = buckets
+		self._counts = [0] * (len(buckets) + 1)
+		self._count = 0
+		self._sum = 0
+		self._max = 0
+
+	def observe(self, value):
+		self._counts[bisect_left(self._buckets, value)] += 1
+		self._count += 1
+		self._sum += value
+		if value > self._max:
+			self._max = value
+
+	def snapshot(self):
+		buckets = []
+		for index, bound in enumerate(self._buckets):
+			buckets.append((bound, self._counts[index]))
+		buckets.append(('inf', self._counts[-1]))
+		return {
+			'count': self._count,
+			'sum': self._sum,
+			'max': self._max,
+			'buckets': buckets,
+		}
+
+_counters = {}
+_histograms = {}
+
+def incr(name, value=1):
+	_counters[name] = _counters.get(name, 0) + value
+
+def set_value(name, value):
+	_counters[name] = value
+
+def get_value(name, default=0):
+	return _counters.get(name, default)
+
+def observe(name, value):
+	histogram = _histograms.get(name)
+	if histogram is None:
+		histogram = _histograms[name] = Histogram()
+	histogram.observe(value)
+
+def snapshot():
+	result = dict(_counters)
+	for name, histogram in _histograms.iteritems():
+		result[name] = histogram.snapshot()
+	return result
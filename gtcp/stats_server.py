@@ -0,0 +1,31 @@
+'''
+HTTP endpoint serving a GTcpServer's stats as json on GET / or /stats.
+
+collect() is called on every request, the counters behind it are kept
+up to date on the packet path so scraping costs one snapshot.
+'''
+from tornado.web import Application, RequestHandler
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_unix_socket
+import jsonutils
+
+class StatsHandler(RequestHandler):
+
+	def initialize(self, collect):
+		self._collect = collect
+
+	def get(self):
+		self.set_header('Content-Type', 'application/json')
+		self.write(jsonutils.to_json(self._collect()))
+
+def start_stats_server(collect, address='', port=None, path=None):
+	'''
+	listens on a unix socket when path is given, otherwise on a tcp port
+	'''
+	application = Application([(r'/(?:stats)?', StatsHandler, dict(collect=collect))])
+	server = HTTPServer(application)
+	if path is not None:
+		server.add_socket(bind_unix_socket(path))
+	else:
+		server.listen(port, address)
+	return server
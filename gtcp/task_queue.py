@@ -0,0 +1,160 @@
+from collections import deque
+from simplequeue import SimpleQueue
+
+# fixed cost charged per task on top of its packet size, so empty CONNECT/DISCONNECT tasks are not free
+FAIR_TASK_OVERHEAD = 64
+
+class _Lane(object):
+
+	def __init__(self, name, weight, queue):
+		self.name = name
+		self.weight = weight
+		self.credit = weight
+		self.queue = queue
+
+class LaneQueue(object):
+	'''
+	Task queue split into lanes served by weighted round robin, first lane first.
+
+	classify(task) picks a task's lane. While a client still has tasks queued,
+	its new tasks join the same lane instead, so one client's tasks are never
+	reordered. Clients need queued_tasks and queued_lane attributes, both
+	shared by every queue the client has tasks in, so the lane is only kept
+	when it belongs to this queue.
+	'''
+
+	def __init__(self, lanes, classify, queue_factory=SimpleQueue):
+		self._lanes = [_Lane(name, max(1, weight), queue_factory()) for name, weight in lanes]
+		self._lanes_by_name = dict((lane.name, lane) for lane in self._lanes)
+		self._classify = classify
+		self._size = 0
+		self._current = 0
+
+	def size(self):
+		return self._size
+
+	def empty(self):
+		return self._size <= 0
+
+	def client_size(self, client):
+		return client.queued_tasks
+
+	def lane_sizes(self):
+		return dict((lane.name, lane.queue.size()) for lane in self._lanes)
+
+	def put(self, task):
+		client = task.client
+		lane = client.queued_lane
+		if client.queued_tasks <= 0 or self._lanes_by_name.get(lane.name) is not lane:
+			lane = self._lanes_by_name[self._classify(task)]
+			client.queued_lane = lane
+		lane.queue.put(task)
+		client.queued_tasks += 1
+		self._size += 1
+
+	def get(self):
+		while True:
+			lane = self._lanes[self._current]
+			if lane.credit > 0 and not lane.queue.empty():
+				lane.credit -= 1
+				return self._pop(lane)
+			lane.credit = lane.weight
+			self._current = (self._current + 1) % len(self._lanes)
+
+	def put_back(self, task):
+		'''
+		returns a task just taken by get to the front of its lane and refunds its credit
+		'''
+		client = task.client
+		lane = client.queued_lane
+		if lane is None or self._lanes_by_name.get(lane.name) is not lane:
+			lane = self._lanes_by_name[self._classify(task)]
+			client.queued_lane = lane
+		lane.queue.put_back(task)
+		lane.credit += 1
+		client.queued_tasks += 1
+		self._size += 1
+
+	def _pop(self, lane):
+		task = lane.queue.get()
+		task.client.queued_tasks -= 1
+		self._size -= 1
+		return task
+
+class _Flow(object):
+
+	__slots__ = ('tasks', 'deficit')
+
+	def __init__(self):
+		self.tasks = deque()
+		self.deficit = 0
+
+class FairQueue(object):
+	'''
+	Task queue served by deficit round robin over clients.
+
+	Each client with queued tasks has a flow, visited in turn and allowed
+	quantum bytes of packets per visit, so a client pipelining many packets
+	only delays others by its share. Flows only exist while they hold tasks.
+	Every operation is O(1), a task larger than the quantum waits
+	size / quantum visits of its own flow.
+	'''
+
+	def __init__(self, quantum):
+		self._quantum = quantum
+		self._flows = {}
+		self._active = deque()
+		self._size = 0
+
+	def size(self):
+		return self._size
+
+	def empty(self):
+		return self._size <= 0
+
+	def client_size(self, client):
+		flow = self._flows.get(client)
+		if flow is None:
+			return 0
+		return len(flow.tasks)
+
+	def put(self, task):
+		flow = self._flows.get(task.client)
+		if flow is None:
+			flow = self._flows[task.client] = _Flow()
+			self._active.append(task.client)
+		flow.tasks.append(task)
+		self._size += 1
+
+	def get(self):
+		while True:
+			client = self._active[0]
+			flow = self._flows[client]
+			cost = len(flow.tasks[0].packet) + FAIR_TASK_OVERHEAD
+			if flow.deficit >= cost:
+				flow.deficit -= cost
+				return self._pop(client)
+			flow.deficit += self._quantum
+			self._active.rotate(-1)
+
+	def put_back(self, task):
+		'''
+		returns a task just taken by get to the front of its flow and refunds its cost
+		'''
+		flow = self._flows.get(task.client)
+		if flow is None:
+			flow = self._flows[task.client] = _Flow()
+			self._active.appendleft(task.client)
+		flow.tasks.appendleft(task)
+		flow.deficit += len(task.packet) + FAIR_TASK_OVERHEAD
+		self._size += 1
+
+	def _pop(self, client):
+		flow = self._flows[client]
+		task = flow.tasks.popleft()
+		self._size -= 1
+		if not flow.tasks:
+			del self._flows[client]
+			# an emptied flow is always at the front, it is the one being served
+			self._active.popleft()
+		return task
@@ -1,24 +1,147 @@
+import os
+import sys
 import random
 import struct
+import time
 import platform
 from tornado.ioloop import IOLoop
 from tornado.tcpserver import TCPServer
+from tornado.netutil import bind_sockets, bind_unix_socket
+from tornado import process
 import socket
+import threading
+from Queue import Queue
+from collections import deque
+from itertools import islice
 from logger import log
 import crypt
 from simplequeue import SimpleQueue
+from task_queue import LaneQueue, FairQueue
+from frame_decoder import FrameDecoder
+from worker_pool import WorkerPool, WORKER_SELECTION_FIFO
+from timing_wheel import TimingWheel
+from reorder_buffer import ReorderBuffer
+from stats_server import start_stats_server
+import event_loop
+import jsonutils
+import stats
 
 IPV6_V4_PREFIX = '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xff'
 IPV6_SIZE = 16
+UNIX_REMOTE_IP = '\0' * IPV6_SIZE
 GTCP_PACKET_STUB_SIZE = 20
 GTCP_CMD_SIZE = 1
 GTCP_HEADER_SIZE = GTCP_CMD_SIZE + GTCP_PACKET_STUB_SIZE
 GTCP_CMD_RELAY = '\x00'
 GTCP_CMD_NONE = '\x01'
 GTCP_CMD_ERROR = '\x02'
+GTCP_CMD_BATCH = '\x03'
 GTCP_CMD_CONNECT = '\x11'
 GTCP_CMD_DISCONNECT = '\x12'
 GTCP_CMD_NOTIFY = '\x13'
+GTCP_CMD_MULTICAST = '\x14'
+GTCP_CMD_WORKER_HELLO = '\x21'
+GTCP_WORKER_FLAG_CONCURRENT = 0x01
+GTCP_WORKER_ROUTING_IDLE = 'idle'
+GTCP_WORKER_ROUTING_STICKY = 'sticky'
+GTCP_WORKER_TRANSPORT_SOCKET = 'socket'
+GTCP_WORKER_TRANSPORT_SHM = 'shm'
+GTCP_WORKER_POOL_DEFAULT = 'default'
+GTCP_LANE_CONTROL = 'control'
+GTCP_LANE_RELAY = 'relay'
+GTCP_ERROR_TIMEOUT = 'timeout'
+GTCP_ERROR_OVERLOAD = 'overload'
+GTCP_ERROR_CLIENT_LIMIT = 'client_limit'
+GTCP_WRITE_OVERFLOW_DROP_OLDEST = 'drop_oldest'
+GTCP_WRITE_OVERFLOW_DROP_NEW = 'drop_new'
+GTCP_WRITE_OVERFLOW_DISCONNECT = 'disconnect'
+
+GTCP_BATCH_HEADER = GTCP_CMD_BATCH + '\0' * GTCP_PACKET_STUB_SIZE
+GTCP_MULTICAST_HEADER = GTCP_CMD_MULTICAST + '\0' * GTCP_PACKET_STUB_SIZE
+
+def pack_batch(frames):
+	buf = [GTCP_BATCH_HEADER]
+	for frame in frames:
+		buf.append(struct.pack('<I', len(frame)))
+		buf.append(frame)
+	return ''.join(buf)
+
+def pack_batches(frames, max_size):
+	'''
+	packs frames into as few batches of at most max_size bytes as it takes, a frame too big to share one goes alone
+	'''
+	batches = []
+	batch = []
+	batch_size = GTCP_HEADER_SIZE
+	for frame in frames:
+		frame_size = 4 + len(frame)
+		if batch and batch_size + frame_size > max_size:
+			batches.append(pack_batch(batch))
+			batch = []
+			batch_size = GTCP_HEADER_SIZE
+		batch.append(frame)
+		batch_size += frame_size
+	if batch:
+		batches.append(pack_batch(batch))
+	return batches
+
+def unpack_batch(data):
+	frames = []
+	offset = GTCP_HEADER_SIZE
+	data_size = len(data)
+	while offset < data_size:
+		if offset + 4 > data_size:
+			return None
+		(frame_size,) = struct.unpack_from('<I', data, offset)
+		offset += 4
+		if offset + frame_size > data_size:
+			return None
+		frames.append(data[offset:offset + frame_size])
+		offset += frame_size
+	return frames
+
+def pack_multicast(client_ids, packet):
+	buf = [GTCP_MULTICAST_HEADER, struct.pack('<I', len(client_ids))]
+	buf.extend(client_ids)
+	buf.append(packet)
+	return ''.join(buf)
+
+def unpack_multicast(data):
+	'''
+	returns (client_ids, packet), or None if the frame is malformed
+	'''
+	offset = GTCP_HEADER_SIZE + 4
+	if len(data) < offset:
+		return None
+	(client_count,) = struct.unpack_from('<I', data, GTCP_HEADER_SIZE)
+	packet_offset = offset + client_count * GTCP_PACKET_STUB_SIZE
+	if packet_offset > len(data):
+		return None
+	client_ids = [data[i:i + GTCP_PACKET_STUB_SIZE] for i in xrange(offset, packet_offset, GTCP_PACKET_STUB_SIZE)]
+	return client_ids, data[packet_offset:]
+
+def max_task_frame_size(config):
+	'''
+	biggest frame the gateway sends a worker, a task with the biggest packet a client may send, batches included
+	'''
+	return GTCP_HEADER_SIZE + config.TCP_MAX_PACKET_SIZE - 1
+
+def get_client_gateway(client_id):
+	'''
+	index of the gateway process owning a client, kept in the low byte of the id padding
+	'''
+	return ord(client_id[-1])
+
+def get_gateway_endpoint(endpoint, gateway_index):
+	'''
+	gateway n of a multi-process front-end uses port + n, or path.n for a unix socket
+	'''
+	endpoint = dict(endpoint)
+	if 'path' in endpoint:
+		endpoint['path'] = '%s.%d' % (endpoint['path'], gateway_index)
+	else:
+		endpoint['port'] += gateway_index
+	return endpoint
 
 class TcpEndpoint(object):
 	
@@ -68,35 +191,66 @@ class TcpEndpoint(object):
 		return self._port
 	
 class WorkerTask(object):
-	def __init__(self, client, cmd, packet=''):
+	def __init__(self, client, cmd, packet='', pool=None):
 		self.client = client
 		self.cmd = cmd
 		self.packet = packet
+		self.pool = pool
+		self.enqueue_time = time.time()
+		# False for the tasks of a batch but its last, a frame is done once its last task is answered
+		self.batch_last = True
+		self.expired = False
+		# kept on a worker for a frame it was sent, once the task itself went to another worker
+		self.stand_in = False
 
 class GTcpConnection(object):
+	'''
+	one per client socket, so it keeps no __dict__ and only what it needs after the handshake:
+	the remote address is formatted from the id when asked for
+	'''
+
+	__slots__ = ('_stream', '_id', '_on_packet_callback', '_on_close_callback', '_reading_paused', '_reading', '_decoder', '_pending_packets', '_write_buffer',
+		'_write_backlog', '_write_backlog_size', '_max_write_size', '_write_overflow', '_write_overflowing',
+		'sticky_worker', 'sticky_ring_version', 'queued_tasks', 'queued_lane', 'pool_tasks', 'disconnect_deferred', 'wheel_deadline', 'wheel_slot')
 	
-	HEADER_SIZE = 4
+	READ_CHUNK_SIZE = 65536
+	READ_BYTES_STAT = 'tcp_read_bytes'
+	WRITE_BYTES_STAT = 'tcp_write_bytes'
+	WRITE_COUNT_STAT = 'tcp_write_count'
+	_unix_connection_count = 0
 	
-	def __init__(self, stream, address, config, on_packet=None, on_close=None):
+	def __init__(self, stream, address, config, on_packet=None, on_close=None, gateway_index=None):
 		self._stream = stream
-		self._address = address
-		if stream.socket.family == socket.AF_INET6:
-			self._remote_ip = socket.inet_pton(socket.AF_INET6, address[0])
+		family = stream.socket.family
+		if family == socket.AF_UNIX:
+			# unix socket peers have no address, number them to keep ids unique
+			GTcpConnection._unix_connection_count = (GTcpConnection._unix_connection_count + 1) & 0xffff
+			remote_ip = UNIX_REMOTE_IP
+			remote_port = GTcpConnection._unix_connection_count
 		else:
-			self._remote_ip = IPV6_V4_PREFIX + socket.inet_aton(address[0])
-		self._remote_port = self._address[1]
-		self._remote_address = '%s:%d' % address
-		self._config = config
+			if family == socket.AF_INET6:
+				remote_ip = socket.inet_pton(socket.AF_INET6, address[0])
+			else:
+				remote_ip = IPV6_V4_PREFIX + socket.inet_aton(address[0])
+			remote_port = address[1]
 		if config.CONNECTION_ID_RANDOM_PADDING:
 			padding = random.randint(0, 0xffff)
 		else:
 			padding = 0
-		self._id = struct.pack('!16sHH', self._remote_ip, self._remote_port, padding)
+		if gateway_index is not None:
+			padding = (padding & 0xff00) | gateway_index
+		self._id = struct.pack('!16sHH', remote_ip, remote_port, padding)
 		self._on_packet_callback = on_packet
 		self._on_close_callback = on_close
-		self._set_keep_alive()
+		self._reading_paused = False
+		self._reading = False
+		self._decoder = FrameDecoder(config.TCP_MAX_PACKET_SIZE)
+		self._pending_packets = None
+		self._write_buffer = None
+		self._write_backlog = None
+		self._set_keep_alive(config, family)
 		self._stream.set_close_callback(self._on_close)
-		self._recv_header()
+		self._recv()
 		
 	@property
 	def id(self):
@@ -104,54 +258,198 @@ class GTcpConnection(object):
 	
 	@property
 	def remote_address(self):
-		return self._remote_address
+		if self._id.startswith(UNIX_REMOTE_IP):
+			(port,) = struct.unpack_from('!H', self._id, IPV6_SIZE)
+			return 'unix:%d' % port
+		return TcpEndpoint(self._id).address
 	
 	def closed(self):
 		return self._stream.closed()
 
-	def _set_keep_alive(self):
-		if not self._config.ENABLE_KEEP_ALIVE:
+	def _set_keep_alive(self, config, family):
+		if not config.ENABLE_KEEP_ALIVE or family == socket.AF_UNIX:
 			return
 		stream_socket = self._stream.socket
 		stream_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 		if platform.system().lower() == 'linux':
-			stream_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, self._config.KEEP_ALIVE_OPT['timeout'])
-			stream_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, self._config.KEEP_ALIVE_OPT['interval'])
-			stream_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, self._config.KEEP_ALIVE_OPT['count'])
+			stream_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, config.KEEP_ALIVE_OPT['timeout'])
+			stream_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, config.KEEP_ALIVE_OPT['interval'])
+			stream_socket.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, config.KEEP_ALIVE_OPT['count'])
 			
-	def send(self, data):
-		self._stream.write(data)
+	def limit_write_buffer(self, max_size, overflow=GTCP_WRITE_OVERFLOW_DISCONNECT):
+		'''
+		bounds the bytes waiting to be written to a peer that reads slower than it is sent to,
+		frames then wait in a backlog until the stream has written out what it holds, and once the
+		backlog and the stream hold max_size bytes a new droppable frame is dropped, evicts the oldest
+		droppable frames of the backlog or closes the connection; frames sent as droppable are notifies,
+		a reply is never dropped and closes the connection when evicting notifies leaves no room for it
+		'''
+		self._write_backlog = deque()
+		self._write_backlog_size = 0
+		self._max_write_size = max_size
+		self._write_overflow = overflow
+		self._write_overflowing = False
+
+	def send(self, data, droppable=False):
+		if self._write_backlog is not None:
+			self._queue_frame((data,), len(data), droppable)
+			return
+		# everything sent during one IOLoop iteration goes out in a single write
+		if self._write_buffer is None:
+			self._write_buffer = [data]
+			event_loop.add_callback(self._flush)
+		else:
+			self._write_buffer.append(data)
 		
-	def send_packet(self, packet):
+	def send_packet(self, packet, droppable=False):
 		header = struct.pack('<I', len(packet))
-		self.send(header + packet)
+		if self._write_backlog is not None:
+			self._queue_frame((header, packet), len(header) + len(packet), droppable)
+			return
+		self.send(header)
+		self.send(packet)
 		
 	def close(self):
+		self._flush()
+		self._stream.close()
+
+	def _queue_frame(self, frame, size, droppable):
+		if self._stream.closed():
+			return
+		if not self._write_fits(size) and not self._on_write_overflow(size, droppable):
+			return
+		if not self._write_backlog and not self._stream.writing():
+			event_loop.add_callback(self._flush)
+		self._write_backlog.append((frame, size, droppable))
+		self._write_backlog_size += size
+
+	def _write_fits(self, size):
+		return self._stream._write_buffer_size + self._write_backlog_size + size <= self._max_write_size
+
+	def _on_write_overflow(self, size, droppable):
+		'''
+		returns True once there is room for the new frame
+		'''
+		stats.incr('tcp_slow_consumer')
+		if not self._write_overflowing:
+			self._write_overflowing = True
+			log.warn('tcp_conn_slow_consumer|remote=%s,policy=%s,buffered=%u,backlog=%u', self.remote_address, self._write_overflow,
+				self._stream._write_buffer_size, self._write_backlog_size)
+		if self._write_overflow != GTCP_WRITE_OVERFLOW_DISCONNECT:
+			if droppable and self._write_overflow == GTCP_WRITE_OVERFLOW_DROP_NEW:
+				self._drop_frame(size)
+				return False
+			if self._evict_frames(size):
+				return True
+			if droppable:
+				self._drop_frame(size)
+				return False
+		stats.incr('tcp_slow_consumer_disconnect')
+		# what is buffered is dropped with the connection, a clean close would only wait for it
 		self._stream.close()
+		return False
+
+	def _evict_frames(self, size):
+		'''
+		drops droppable frames of the backlog, oldest first, until size more bytes fit,
+		frames the stream holds may be half written so only the backlog can be evicted
+		'''
+		backlog = self._write_backlog
+		self._write_backlog = deque()
+		for entry in backlog:
+			frame, frame_size, droppable = entry
+			if droppable and not self._write_fits(size):
+				self._write_backlog_size -= frame_size
+				self._drop_frame(frame_size)
+			else:
+				self._write_backlog.append(entry)
+		return self._write_fits(size)
+
+	def _drop_frame(self, size):
+		stats.incr('tcp_slow_consumer_dropped')
+		stats.incr('tcp_slow_consumer_dropped_bytes', size)
+
+	def _flush(self):
+		if self._write_backlog is not None:
+			self._flush_backlog()
+			return
+		write_buffer = self._write_buffer
+		if write_buffer is None:
+			return
+		self._write_buffer = None
+		if self._stream.closed():
+			return
+		data = ''.join(write_buffer)
+		stats.incr(self.WRITE_COUNT_STAT)
+		stats.incr(self.WRITE_BYTES_STAT, len(data))
+		self._stream.write(data)
+
+	def _flush_backlog(self):
+		# runs again once the stream has written everything out, until the backlog is empty
+		if not self._write_backlog or self._stream.closed() or self._stream.writing():
+			return
+		data = ''.join([chunk for frame, size, droppable in self._write_backlog for chunk in frame])
+		self._write_backlog.clear()
+		self._write_backlog_size = 0
+		self._write_overflowing = False
+		stats.incr(self.WRITE_COUNT_STAT)
+		stats.incr(self.WRITE_BYTES_STAT, len(data))
+		self._stream.write(data, self._flush_backlog)
+
+	def pause_reading(self):
+		'''
+		stops handing packets on once the current one is handled, those already read wait in the
+		connection, the kernel buffers then fill up and the peer is throttled by tcp
+		'''
+		self._reading_paused = True
+
+	def resume_reading(self):
+		self._reading_paused = False
+		if self._pending_packets is not None:
+			packets = self._pending_packets
+			self._pending_packets = None
+			self._deliver_packets(packets)
+		if not self._reading and not self._reading_paused and not self._stream.closed():
+			self._recv()
 		
-	def _recv_header(self):
-		self._stream.read_bytes(self.HEADER_SIZE, self._on_recv_header)
+	def _recv(self):
+		self._reading = True
+		self._stream.read_bytes(self.READ_CHUNK_SIZE, self._on_recv, partial=True)
 		
-	def _on_recv_header(self, data):
-		if len(data) != self.HEADER_SIZE:
-			log.error('tcp_conn_header_size_error|remote=%s,header=%s', self._remote_address, data.encode('hex'))
+	def _on_recv(self, data):
+		stats.incr(self.READ_BYTES_STAT, len(data))
+		self._deliver_packets(self._decoder.feed(data))
+		if self._decoder.error:
+			log.error('tcp_conn_body_size_overflow|remote=%s,size=%u', self.remote_address, self._decoder.frame_size)
 			self._stream.close()
 			return
-		(body_size,) = struct.unpack('<I', data)
-		if body_size >= self._config.TCP_MAX_PACKET_SIZE:
-			log.error('tcp_conn_body_size_overflow|remote=%s,size=%u', self._remote_address, body_size)
-			self._stream.close()
+		if self._reading_paused or self._stream.closed():
+			self._reading = False
 			return
-		self._stream.read_bytes(body_size, self._on_recv_body)
-		
-	def _on_recv_body(self, data):
-		if self._on_packet_callback is not None:
-			self._on_packet_callback(self, data)
-		self._stream.read_bytes(self.HEADER_SIZE, self._on_recv_header)
+		self._stream.read_bytes(self.READ_CHUNK_SIZE, self._on_recv, partial=True)
 	
+	def _deliver_packets(self, packets):
+		for i, packet in enumerate(packets):
+			if self._stream.closed():
+				return
+			if self._reading_paused:
+				self._pending_packets = packets[i:]
+				return
+			if self._on_packet_callback is not None:
+				self._on_packet_callback(self, packet)
+
 	def _on_close(self):
 		if self._on_close_callback is not None:
 			self._on_close_callback(self)
+
+class WorkerConnection(GTcpConnection):
+	'''
+	a worker's socket, it keeps a __dict__ for the attributes GTcpServer tracks per worker
+	'''
+
+	READ_BYTES_STAT = 'worker_read_bytes'
+	WRITE_BYTES_STAT = 'worker_write_bytes'
+	WRITE_COUNT_STAT = 'worker_write_count'
 			
 class CallbackTcpServer(TCPServer):
 	
@@ -159,6 +457,15 @@ class CallbackTcpServer(TCPServer):
 		self._on_connect_callback = on_connect
 		super(CallbackTcpServer, self).__init__(*args, **kwargs)
 		
+	def listen_endpoint(self, address='', port=None, path=None, reuse_port=False):
+		'''
+		listens on a unix socket when path is given, otherwise on a tcp port
+		'''
+		if path is not None:
+			self.add_socket(bind_unix_socket(path))
+		else:
+			self.add_sockets(bind_sockets(port, address, reuse_port=reuse_port))
+
 	def handle_stream(self, stream, address):
 		if self._on_connect_callback:
 			self._on_connect_callback(stream, address)
@@ -169,13 +476,45 @@ class Processor(object):
 		self._id = id
 		self._config = config
 		self._client = None
+		self._work_endpoint = config.WORK_ENDPOINT
+		self._shm_channel = None
+		self._pool_name = GTCP_WORKER_POOL_DEFAULT
+		self._thread_count = getattr(config, 'WORKER_THREAD_COUNT', 1)
+		# the gateway reads worker frames with the limit it puts on client packets
+		self._max_reply_size = config.TCP_MAX_PACKET_SIZE - 1
+		self._local = threading.local()
+		self._write_lock = None
+		self._replies = None
+
+	@property
+	def _batch_replies(self):
+		# a batch is handled on a single thread, its replies are private to that thread
+		return getattr(self._local, 'batch_replies', None)
+
+	@_batch_replies.setter
+	def _batch_replies(self, replies):
+		self._local.batch_replies = replies
 	
 	def run(self):
 		random.seed()
 		self.on_init()
 		from gtcpclient import GTcpClient
-		log.info('tcp_worker_start|id=%d', self._id)
-		self._client = GTcpClient(self._config.WORK_ENDPOINT['address'], self._config.WORK_ENDPOINT['port'], 0)
+		log.info('tcp_worker_start|id=%d,threads=%d', self._id, self._thread_count)
+		endpoint = self._work_endpoint
+		if self._shm_channel is not None:
+			from shm_ring import ShmRingClient
+			if not self._config.DEBUG:
+				self._shm_channel.close_gateway_end()
+			self._client = ShmRingClient(self._shm_channel, getattr(self._config, 'SHM_POLL_INTERVAL', 0.01), on_connect=self._on_connect)
+		else:
+			# handler threads must not reconnect on a failed send, see _run_threads
+			retry = self._thread_count <= 1
+			if 'path' in endpoint:
+				self._client = GTcpClient(endpoint['path'], None, 0, retry=retry, on_connect=self._on_connect)
+			else:
+				self._client = GTcpClient(endpoint['address'], endpoint['port'], 0, retry=retry, on_connect=self._on_connect)
+		if self._thread_count > 1:
+			self._run_threads()
 		while True:
 			try:
 				request = self._client.receive()
@@ -185,27 +524,193 @@ class Processor(object):
 				elif len(request) < GTCP_HEADER_SIZE:
 					log.error('tcp_worker_request_packet_error|client_id=%s,client=%s,request=%s', self._client.id.encode('hex'), self._client.remote_address, request.encode('hex'))
 					self._client.close()
+				elif request[:GTCP_CMD_SIZE] == GTCP_CMD_BATCH:
+					self._handle_batch(request)
 				else:
-					request_cmd = request[:GTCP_CMD_SIZE]
-					request_client = TcpEndpoint(request[GTCP_CMD_SIZE:GTCP_HEADER_SIZE])
-					reply_body = None
-					if request_cmd == GTCP_CMD_RELAY:
-						request_body = request[GTCP_HEADER_SIZE:]
-						reply_body = self.on_packet(request_client, request_body)
-					elif request_cmd == GTCP_CMD_CONNECT:
-						reply_body = self.on_client_connect(request_client)
-					elif request_cmd == GTCP_CMD_DISCONNECT:
-						self.on_client_disconnect(request_client)
-					if reply_body is None:
-						self._client.send(GTCP_CMD_NONE + request_client.client_id)
-					else:
-						self._client.send(GTCP_CMD_RELAY + request_client.client_id + reply_body)
+					self._client.send(self._handle_request(request))
 			except Exception as ex:
 				log.exception('tcp_worker_exception|id=%u,exception=%s', self._id, ex, exc_info=True)
+				self._batch_replies = None
 				self._client.close()
 
+	def _run_threads(self):
+		'''
+		this thread reads tasks and hands them to a pool of handler threads,
+		replies go out under the write lock in the order their tasks came in
+		handlers run concurrently and have to be thread safe, the frames of a batch share one thread
+		only this thread connects, a handler finding the connection lost drops its frames, as a reply owed
+		on it would be taken by the gateway for that of another task on the next one
+		'''
+		self._write_lock = threading.Lock()
+		self._replies = ReorderBuffer()
+		tasks = Queue()
+		for i in xrange(self._thread_count):
+			thread = threading.Thread(target=self._run_task_thread, args=(tasks,))
+			thread.daemon = True
+			thread.start()
+		while True:
+			try:
+				with self._write_lock:
+					if not self._client.connected():
+						# replies owed on the lost connection are dropped, the gateway hands their tasks to other workers
+						self._replies = ReorderBuffer()
+						if not self._client.connect():
+							continue
+				try:
+					request = self._client.read_packet()
+				except Exception as ex:
+					log.warn('tcp_worker_lost_connection|id=%u,pending=%u,ex=%s', self._id, self._replies.pending_count(), ex)
+					self._reset_connection()
+					continue
+				if len(request) < GTCP_HEADER_SIZE:
+					log.error('tcp_worker_request_packet_error|id=%u,request=%s', self._id, request.encode('hex'))
+					self._reset_connection()
+				elif request[:GTCP_CMD_SIZE] == GTCP_CMD_BATCH:
+					requests = unpack_batch(request)
+					if requests is None:
+						log.error('tcp_worker_batch_error|id=%u,request=%s', self._id, request.encode('hex'))
+						self._reset_connection()
+					else:
+						tasks.put((self._replies, self._replies.reserve(), request, requests))
+				else:
+					tasks.put((self._replies, self._replies.reserve(), request, None))
+			except Exception as ex:
+				log.exception('tcp_worker_exception|id=%u,exception=%s', self._id, ex, exc_info=True)
+				self._reset_connection()
+
+	def _reset_connection(self):
+		with self._write_lock:
+			self._client.close()
+
+	def _run_task_thread(self, tasks):
+		while True:
+			replies, seq, request, requests = tasks.get()
+			if replies is not self._replies:
+				continue
+			try:
+				if requests is None:
+					frames = (self._handle_request(request),)
+				else:
+					frames = self._handle_batch_requests(requests)
+			except Exception as ex:
+				# other tasks share the connection, so the failed frame is answered with no reply instead of a reconnect
+				log.exception('tcp_worker_exception|id=%u,exception=%s', self._id, ex, exc_info=True)
+				self._batch_replies = None
+				if requests is None:
+					frames = (self._none_frame(request),)
+				else:
+					frames = pack_batches([self._none_frame(sub_request) for sub_request in requests], self._max_reply_size)
+			with self._write_lock:
+				if replies is self._replies:
+					for frames in replies.put(seq, frames):
+						for frame in frames:
+							self._send_connected(frame)
+
+	def _handle_request(self, request):
+		request_cmd = request[:GTCP_CMD_SIZE]
+		request_client = TcpEndpoint(request[GTCP_CMD_SIZE:GTCP_HEADER_SIZE])
+		reply_body = None
+		if request_cmd == GTCP_CMD_RELAY:
+			request_body = request[GTCP_HEADER_SIZE:]
+			reply_body = self.on_packet(request_client, request_body)
+		elif request_cmd == GTCP_CMD_CONNECT:
+			reply_body = self.on_client_connect(request_client)
+		elif request_cmd == GTCP_CMD_DISCONNECT:
+			self.on_client_disconnect(request_client)
+		return self._reply_frame(request_client, reply_body)
+
+	@staticmethod
+	def _reply_frame(request_client, reply_body):
+		if reply_body is None:
+			return GTCP_CMD_NONE + request_client.client_id
+		else:
+			return GTCP_CMD_RELAY + request_client.client_id + reply_body
+
+	@staticmethod
+	def _none_frame(request):
+		return GTCP_CMD_NONE + request[GTCP_CMD_SIZE:GTCP_HEADER_SIZE].ljust(GTCP_PACKET_STUB_SIZE, '\0')
+
+	def _handle_batch(self, request):
+		requests = unpack_batch(request)
+		if requests is None:
+			log.error('tcp_worker_batch_error|id=%u,request=%s', self._id, request.encode('hex'))
+			self._client.close()
+			return
+		for frame in self._handle_batch_requests(requests):
+			self._client.send(frame)
+
+	def _handle_batch_requests(self, requests):
+		'''
+		returns the frames of the batch reply, it is split once it outgrows the limit of the gateway
+		'''
+		# notifies sent while handling the batch travel in the batch reply, ahead of their task's reply
+		self._batch_replies = []
+		for sub_request in requests:
+			if len(sub_request) < GTCP_HEADER_SIZE:
+				log.error('tcp_worker_request_packet_error|id=%u,request=%s', self._id, sub_request.encode('hex'))
+				self._batch_replies.append(self._none_frame(sub_request))
+			else:
+				self._batch_replies.append(self._handle_request(sub_request))
+		replies = self._batch_replies
+		self._batch_replies = None
+		return pack_batches(replies, self._max_reply_size)
+
+	def attach_shm_channel(self, channel):
+		self._shm_channel = channel
+
+	def attach_work_endpoint(self, endpoint):
+		self._work_endpoint = endpoint
+
+	def attach_worker_pool(self, name):
+		self._pool_name = name
+
+	def _runs_concurrently(self):
+		'''
+		True when frames after the oldest one in flight can reach a handler before it replies
+		'''
+		return self._thread_count > 1
+
+	def _on_connect(self, client):
+		flags = GTCP_WORKER_FLAG_CONCURRENT if self._runs_concurrently() else 0
+		client.send(GTCP_CMD_WORKER_HELLO + '\0' * GTCP_PACKET_STUB_SIZE + struct.pack('!IB', self._id, flags) + self._pool_name)
+
+	def _send(self, frame):
+		if self._write_lock is None:
+			return self._client.send(frame)
+		with self._write_lock:
+			return self._send_connected(frame)
+
+	def _send_connected(self, frame):
+		# called under the write lock, only the reader thread connects
+		if not self._client.connected():
+			return False
+		return self._client.send(frame)
+
 	def send_packet(self, client_id, packet):
-		return self._client.send(GTCP_CMD_NOTIFY + client_id + packet)
+		if self._batch_replies is not None:
+			self._batch_replies.append(GTCP_CMD_NOTIFY + client_id + packet)
+			return True
+		return self._send(GTCP_CMD_NOTIFY + client_id + packet)
+
+	def send_packet_many(self, client_ids, packet):
+		'''
+		sends one packet to several clients, the gateway fans it out
+		'''
+		# each frame carries as many ids as fit beside the packet within the limit of the gateway
+		chunk_size = (self._max_reply_size - GTCP_HEADER_SIZE - 4 - len(packet)) / GTCP_PACKET_STUB_SIZE
+		if chunk_size < 1:
+			# the packet leaves no room for an id, every client gets a notify of its own
+			for client_id in client_ids:
+				if not self.send_packet(client_id, packet):
+					return False
+			return True
+		for i in xrange(0, len(client_ids), chunk_size):
+			frame = pack_multicast(client_ids[i:i + chunk_size], packet)
+			if self._batch_replies is not None:
+				self._batch_replies.append(frame)
+			elif not self._send(frame):
+				return False
+		return True
 		
 	@property
 	def id(self):
@@ -240,104 +745,971 @@ class Processor(object):
 		to be overridden
 		'''
 		return
-	
+
+	@classmethod
+	def error_packet(cls, request, error):
+		'''
+		to be overridden, runs in the gateway process
+		returns the packet sent to a client whose request failed before a worker replied, or None
+		'''
+		return None
+
+	@classmethod
+	def route_packet(cls, request):
+		'''
+		to be overridden, runs in the gateway process for every request once WORKER_POOLS is set
+		returns the name of the worker pool handling the request, or None for the default pool
+		'''
+		return None
+
+	@classmethod
+	def packet_command(cls, request):
+		'''
+		to be overridden, runs in the gateway process for every request once an inline handler is registered
+		returns the command inline handlers are keyed by, or None
+		'''
+		return None
+
 class GTcpServer(TCPServer):
 	
-	def __init__(self, config, processor_class):
+	def __init__(self, config, processor_class, pool_processor_classes=None):
+		'''
+		requests go to the default pool of WORKER_COUNT workers running processor_class unless
+		processor_class.route_packet names one of the WORKER_POOLS, whose workers run the class
+		given for them in pool_processor_classes or processor_class
+		'''
+		self._gateway_count = getattr(config, 'GATEWAY_COUNT', 1)
+		if self._gateway_count > 1:
+			# every gateway process returns from here with its index, the parent only supervises them
+			self._gateway_index = process.fork_processes(self._gateway_count)
+			if self._gateway_index is None:
+				sys.exit(0)
+			log.info('tcp_server_gateway_start|index=%u,pid=%s', self._gateway_index, os.getpid())
+		else:
+			self._gateway_index = 0
 		if config.DEBUG:
 			from threading import Thread as Process
 		else:
 			from multiprocessing import Process
 		self._config = config
+		self._processor_class = processor_class
+		self._process_class = Process
 		self._clients = {}
-		self._idle_workers = SimpleQueue()
+		self._worker_max_inflight = max(1, getattr(config, 'WORKER_MAX_INFLIGHT', 1))
+		self._worker_batch_size = max(1, getattr(config, 'WORKER_BATCH_SIZE', 1))
+		# a batch is never bigger than a single task can be, so every worker transport takes it
+		self._max_batch_frame_size = max_task_frame_size(config)
+		self._worker_selection = getattr(config, 'WORKER_SELECTION', WORKER_SELECTION_FIFO)
+		self._worker_ewma_alpha = getattr(config, 'WORKER_EWMA_ALPHA', 0.2)
 		self._max_queue_size = getattr(config, 'TCP_MAX_QUEUE_SIZE', None)
-		self._running_workers = SimpleQueue()
-		self._waiting_tasks = SimpleQueue(self._max_queue_size)
-		self._worker_processes = []
+		self._queue_high_water = getattr(config, 'TCP_QUEUE_HIGH_WATER', None)
+		self._queue_low_water = getattr(config, 'TCP_QUEUE_LOW_WATER', None)
+		if self._queue_high_water and self._queue_low_water is None:
+			self._queue_low_water = self._queue_high_water / 2
+		self._overload_reply = getattr(config, 'TCP_OVERLOAD_REPLY', False)
+		self._max_write_size = getattr(config, 'TCP_MAX_WRITE_BUFFER_SIZE', None)
+		self._write_overflow = getattr(config, 'TCP_WRITE_OVERFLOW', GTCP_WRITE_OVERFLOW_DISCONNECT)
+		# tasks accepted from clients and not yet sent to a worker, whichever queue holds them
+		self._queued_task_count = 0
+		self._queued_task_max = 0
+		self._reading_paused = False
+		lane_weights = getattr(config, 'TASK_LANE_WEIGHTS', None)
+		if lane_weights:
+			self._task_lanes = [(name, lane_weights.get(name, 1)) for name in (GTCP_LANE_CONTROL, GTCP_LANE_RELAY)]
+		else:
+			self._task_lanes = None
+		self._fair_quantum = getattr(config, 'TASK_FAIR_QUANTUM', None)
+		self._max_client_tasks = getattr(config, 'TASK_MAX_PER_CLIENT', None)
+		self._inline_handlers = {}
+		self._inline_overruns = {}
+		self._inline_budget = getattr(config, 'INLINE_HANDLER_BUDGET', 0.001)
+		self._inline_max_overruns = getattr(config, 'INLINE_HANDLER_MAX_OVERRUNS', 3)
+		self._worker_processes = {}
+		self._respawn_backoff = getattr(config, 'WORKER_RESPAWN_BACKOFF', 0.5)
+		self._respawn_backoff_max = getattr(config, 'WORKER_RESPAWN_BACKOFF_MAX', 30)
+		self._respawn_failures = 0
+		self._next_respawn_time = 0
+		self._workers_started = False
+		self._task_timeout = getattr(config, 'WORKER_TASK_TIMEOUT', None)
+		self._restart_on_timeout = getattr(config, 'WORKER_RESTART_ON_TIMEOUT', False)
+		self._worker_routing = getattr(config, 'WORKER_ROUTING', GTCP_WORKER_ROUTING_IDLE)
+		if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+			from conhash import ConHash
+			self._conhash_class = ConHash
+			self._sticky_ring_version = 0
+			self._sticky_replica = getattr(config, 'WORKER_STICKY_REPLICA', 32)
+			self._steal_threshold = getattr(config, 'WORKER_STEAL_THRESHOLD', 16)
+		self._default_pool = self._create_worker_pool(GTCP_WORKER_POOL_DEFAULT, processor_class, config.WORKER_COUNT, getattr(config, 'WORKER_SPARE_COUNT', 0))
+		self._worker_pools = {GTCP_WORKER_POOL_DEFAULT: self._default_pool}
+		pool_processor_classes = pool_processor_classes or {}
+		for name, pool_config in getattr(config, 'WORKER_POOLS', {}).iteritems():
+			self._worker_pools[name] = self._create_worker_pool(name, pool_processor_classes.get(name, processor_class),
+				pool_config['worker_count'], pool_config.get('spare_worker_count', 0))
 		
 		max_buffer_size = getattr(config, 'TCP_MAX_BUFFER_SIZE', None)
-		self._worker_server = CallbackTcpServer(on_connect=self._on_worker_connect, max_buffer_size=max_buffer_size)
-		self._worker_server.listen(**config.WORK_ENDPOINT)
+		if self._gateway_count > 1:
+			self._work_endpoint = get_gateway_endpoint(config.WORK_ENDPOINT, self._gateway_index)
+		else:
+			self._work_endpoint = config.WORK_ENDPOINT
+		self._worker_transport = getattr(config, 'WORKER_TRANSPORT', GTCP_WORKER_TRANSPORT_SOCKET)
+		if self._worker_transport == GTCP_WORKER_TRANSPORT_SHM:
+			import shm_ring
+			# the rings need stores to become visible in program order, which x86 gives for free
+			machine = platform.machine().lower()
+			if machine not in shm_ring.SHM_MACHINES:
+				raise RuntimeError('shm_transport_unsupported: WORKER_TRANSPORT=shm needs x86, machine is %s' % (machine or 'unknown'))
+			self._shm_ring = shm_ring
+			self._shm_ring_size = getattr(config, 'SHM_RING_SIZE', 4 * 1024 * 1024)
+			self._shm_poll_interval = getattr(config, 'SHM_POLL_INTERVAL', 0.01)
+			# a task with a packet of the biggest size a client may send has to fit in the task ring at once
+			max_task_size = max_task_frame_size(config)
+			if max_task_size > shm_ring.max_frame_size(self._shm_ring_size):
+				raise RuntimeError('shm_ring_size_too_small: SHM_RING_SIZE=%u, tasks take up to %u bytes' % (self._shm_ring_size, max_task_size))
+		else:
+			self._worker_server = CallbackTcpServer(on_connect=self._on_worker_connect, max_buffer_size=max_buffer_size)
+			self._worker_server.listen_endpoint(**self._work_endpoint)
 		self._connection_server = CallbackTcpServer(on_connect=self._on_client_connect, max_buffer_size=max_buffer_size)
 		for listen_port in config.LISTEN_ENDPOINTS:
-			self._connection_server.listen(**listen_port)
-		for i in xrange(0, config.WORKER_COUNT):
-			processor = processor_class(i, config)
-			p = Process(target=processor.run)
-			p.processor = processor
-			self._worker_processes.append(p)
-			p.start()
+			self._connection_server.listen_endpoint(reuse_port=self._gateway_count > 1, **listen_port)
+		if self._gateway_count > 1:
+			self._start_gateway_peers(max_buffer_size)
+		self._supervise_workers()
+		self._workers_started = True
+		event_loop.add_interval_timer(getattr(config, 'WORKER_SUPERVISE_INTERVAL', 1), self._supervise_workers)
+		idle_timeout = getattr(config, 'CLIENT_IDLE_TIMEOUT', None)
+		if idle_timeout:
+			self._idle_wheel = TimingWheel(idle_timeout, getattr(config, 'CLIENT_IDLE_TICK', 1), self._on_client_idle)
+			self._idle_wheel.start()
+		else:
+			self._idle_wheel = None
+		stats_interval = getattr(config, 'STATS_LOG_INTERVAL', 60)
+		if stats_interval:
+			event_loop.add_interval_timer(stats_interval, self._log_stats)
+		stats_endpoint = getattr(config, 'STATS_ENDPOINT', None)
+		if stats_endpoint:
+			if self._gateway_count > 1:
+				stats_endpoint = get_gateway_endpoint(stats_endpoint, self._gateway_index)
+			self._stats_server = start_stats_server(self._collect_stats, **stats_endpoint)
+
+	def register_inline_handler(self, command, handler):
+		'''
+		handler(client, request) serves the requests whose processor_class.packet_command is command on the
+		gateway IOLoop instead of a worker, and returns the reply packet or None
+		it must not block and should finish within INLINE_HANDLER_BUDGET seconds, a handler that overruns or
+		raises INLINE_HANDLER_MAX_OVERRUNS times in a row is unregistered and its requests go to the workers
+		its replies can overtake those of earlier requests of the same client still with a worker
+		'''
+		self._inline_handlers[command] = handler
+		self._inline_overruns[command] = 0
+		log.info('tcp_server_inline_handler_register|command=%s', command)
+
+	def _start_gateway_peers(self, max_buffer_size):
+		from gtcpasyncclient import GTcpAsyncClient
+		peer_endpoint = self._config.GATEWAY_PEER_ENDPOINT
+		self._peer_server = CallbackTcpServer(on_connect=self._on_peer_connect, max_buffer_size=max_buffer_size)
+		self._peer_server.listen_endpoint(**get_gateway_endpoint(peer_endpoint, self._gateway_index))
+		self._gateway_peers = {}
+		for index in xrange(self._gateway_count):
+			if index != self._gateway_index:
+				endpoint = get_gateway_endpoint(peer_endpoint, index)
+				if 'path' in endpoint:
+					address, port = endpoint['path'], None
+				else:
+					address, port = endpoint['address'], endpoint['port']
+				self._gateway_peers[index] = GTcpAsyncClient('gateway_%u' % index, address, port, None)
+
+	def _create_worker_pool(self, name, processor_class, worker_count, spare_worker_count):
+		pool = WorkerPool(name, self._worker_selection, self._worker_ewma_alpha)
+		pool.processor_class = processor_class
+		pool.worker_count = worker_count
+		pool.spare_worker_count = spare_worker_count
+		pool.active_worker_ids = set()
+		pool.spare_worker_ids = set()
+		# spares that said hello, kept out of the pool until a worker dies
+		pool.spare_workers = {}
+		pool.waiting_tasks = self._create_task_queue()
+		if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+			pool.sticky_workers = {}
+			pool.sticky_ring = None
+		return pool
+
+	def _create_task_queue(self):
+		if self._task_lanes:
+			return LaneQueue(self._task_lanes, self._get_task_lane, self._create_lane_queue)
+		return self._create_lane_queue()
+
+	def _create_lane_queue(self):
+		if self._fair_quantum:
+			return FairQueue(self._fair_quantum)
+		return SimpleQueue()
+
+	def _get_client_task_queue(self, pool, client):
+		if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+			worker = self._get_sticky_worker(pool, client)
+			if worker is not None:
+				return worker.waiting_tasks
+		return pool.waiting_tasks
+
+	@staticmethod
+	def _get_task_lane(task):
+		if task.cmd == GTCP_CMD_CONNECT or task.cmd == GTCP_CMD_DISCONNECT:
+			return GTCP_LANE_CONTROL
+		return GTCP_LANE_RELAY
+
+	def _start_worker(self, pool, worker_id):
+		processor = pool.processor_class(worker_id, self._config)
+		processor.attach_work_endpoint(self._work_endpoint)
+		processor.attach_worker_pool(pool.name)
+		if self._worker_transport == GTCP_WORKER_TRANSPORT_SHM:
+			channel = self._shm_ring.ShmChannel(self._shm_ring_size)
+			processor.attach_shm_channel(channel)
+		p = self._process_class(target=processor.run)
+		p.processor = processor
+		p.pool = pool
+		p.start_time = time.time()
+		p.start()
+		if self._worker_transport == GTCP_WORKER_TRANSPORT_SHM:
+			if not self._config.DEBUG:
+				channel.close_worker_end()
+			worker = self._shm_ring.ShmWorkerConnection(channel, worker_id, self._shm_poll_interval, self._on_worker_packet, self._on_worker_close)
+			self._init_worker(worker)
+		return p
+
+	def _restart_worker(self, worker):
+		worker_process = self._worker_processes.get(worker.worker_id)
+		if worker_process is None:
+			return
+		if not hasattr(worker_process, 'terminate'):
+			log.warn('tcp_worker_restart_unsupported|worker_id=%u', worker.worker_id)
+			return
+		log.warn('tcp_worker_restart|worker_id=%u,pid=%s', worker.worker_id, worker_process.pid)
+		stats.incr('worker_restart')
+		worker_process.terminate()
+		# the process is reaped by the supervisor, a spare or a new worker takes the slot now
+		worker.pool.active_worker_ids.discard(worker.worker_id)
+		worker.close()
+		self._supervise_workers()
+
+	def _supervise_workers(self):
+		now = time.time()
+		for worker_id, worker_process in self._worker_processes.items():
+			if worker_process.is_alive():
+				continue
+			del self._worker_processes[worker_id]
+			pool = worker_process.pool
+			if worker_id not in pool.active_worker_ids and worker_id not in pool.spare_worker_ids:
+				continue
+			pool.active_worker_ids.discard(worker_id)
+			pool.spare_worker_ids.discard(worker_id)
+			log.error('tcp_worker_exit|worker_id=%u,pool=%s,pid=%s,exitcode=%s', worker_id, pool.name, getattr(worker_process, 'pid', None), getattr(worker_process, 'exitcode', None))
+			stats.incr('worker_exit')
+			# a worker dying soon after it started is likely to die again, back off respawning
+			if now - worker_process.start_time < self._respawn_backoff_max:
+				self._respawn_failures += 1
+				self._next_respawn_time = now + min(self._respawn_backoff_max, self._respawn_backoff * (2 ** (self._respawn_failures - 1)))
+			else:
+				self._respawn_failures = 0
+		for pool in self._worker_pools.itervalues():
+			while len(pool.active_worker_ids) < pool.worker_count and pool.spare_worker_ids:
+				self._promote_spare_worker(pool)
+		if now < self._next_respawn_time:
+			return
+		for pool in self._worker_pools.itervalues():
+			while len(pool.active_worker_ids) < pool.worker_count:
+				self._spawn_worker(pool, pool.active_worker_ids)
+			while len(pool.spare_worker_ids) < pool.spare_worker_count:
+				self._spawn_worker(pool, pool.spare_worker_ids)
+
+	def _spawn_worker(self, pool, worker_ids):
+		worker_id = 0
+		while worker_id in self._worker_processes:
+			worker_id += 1
+		if self._workers_started:
+			stats.incr('worker_respawn')
+		worker_ids.add(worker_id)
+		self._worker_processes[worker_id] = self._start_worker(pool, worker_id)
+
+	def _promote_spare_worker(self, pool):
+		worker_id = pool.spare_worker_ids.pop()
+		pool.active_worker_ids.add(worker_id)
+		log.info('tcp_worker_promote_spare|worker_id=%u,pool=%s', worker_id, pool.name)
+		stats.incr('worker_spare_promote')
+		worker = pool.spare_workers.pop(worker_id, None)
+		if worker is not None:
+			self._activate_worker(worker)
+
+	def _collect_stats(self):
+		stats.set_value('client_count', len(self._clients))
+		stats.set_value('waiting_task_count', self._queued_task_count)
+		stats.set_value('waiting_task_max', self._queued_task_max)
+		pools = self._worker_pools.values()
+		stats.set_value('worker_count', sum(pool.size() for pool in pools))
+		stats.set_value('idle_worker_count', sum(pool.idle_count() for pool in pools))
+		stats.set_value('running_worker_count', sum(pool.running_count() for pool in pools))
+		stats.set_value('spare_worker_count', sum(len(pool.spare_workers) for pool in pools))
+		stats.set_value('inline_handler_count', len(self._inline_handlers))
+		write_count = stats.get_value('tcp_write_count')
+		if write_count:
+			stats.set_value('tcp_write_bytes_avg', stats.get_value('tcp_write_bytes') / write_count)
+		if self._task_lanes:
+			lane_sizes = {}
+			for pool in pools:
+				for name, size in pool.waiting_tasks.lane_sizes().iteritems():
+					lane_sizes[name] = lane_sizes.get(name, 0) + size
+			for name, size in lane_sizes.iteritems():
+				stats.set_value('waiting_task_count_' + name, size)
+		result = stats.snapshot()
+		workers = {}
+		for pool in pools:
+			for worker in pool.workers():
+				workers[worker.worker_id] = {
+					'pool': pool.name,
+					'state': pool.get_state(worker),
+					'task_count': worker.task_count,
+					'inflight_frames': worker.inflight_frames,
+					'service_time_ewma': worker.service_time_ewma,
+					'waiting_task_count': worker.waiting_tasks.size(),
+				}
+		result['workers'] = workers
+		if len(pools) > 1:
+			result['pools'] = dict((pool.name, {
+				'worker_count': pool.size(),
+				'idle_worker_count': pool.idle_count(),
+				'waiting_task_count': pool.waiting_tasks.size(),
+			}) for pool in pools)
+		return result
+
+	def _log_stats(self):
+		log.data('tcp_server_stats|%s', jsonutils.to_json(self._collect_stats()))
 
 	def _on_client_connect(self, stream, address):
-		client = GTcpConnection(stream, address, self._config, self._on_client_packet, self._on_client_close)
+		gateway_index = self._gateway_index if self._gateway_count > 1 else None
+		client = GTcpConnection(stream, address, self._config, self._on_client_packet, self._on_client_close, gateway_index)
 		if client.id in self._clients:
 			log.error('tcp_server_dup_client|id=%s,remote=%s', client.id.encode('hex'), client.remote_address)
 		self._clients[client.id] = client
+		client.sticky_worker = None
+		client.sticky_ring_version = -1
+		client.queued_tasks = 0
+		client.queued_lane = None
+		client.pool_tasks = 0
+		client.disconnect_deferred = False
+		if self._max_write_size:
+			client.limit_write_buffer(self._max_write_size, self._write_overflow)
+		if self._reading_paused:
+			client.pause_reading()
+		if self._idle_wheel is not None:
+			self._idle_wheel.add(client)
 		self._handle_task(client, GTCP_CMD_CONNECT, '')
 		log.info('tcp_server_client_connect|id=%s,remote=%s', client.id.encode('hex'), client.remote_address)
 		
+	def _on_peer_connect(self, stream, address):
+		peer = GTcpConnection(stream, address, self._config, self._on_peer_packet)
+		log.info('tcp_server_peer_connect|id=%s,remote=%s', peer.id.encode('hex'), peer.remote_address)
+
+	def _on_peer_packet(self, peer, data):
+		if data[:GTCP_CMD_SIZE] == GTCP_CMD_MULTICAST:
+			self._on_multicast(data, False)
+			return
+		if len(data) < GTCP_HEADER_SIZE or data[:GTCP_CMD_SIZE] != GTCP_CMD_NOTIFY:
+			log.error('tcp_server_peer_packet_error|peer=%s,packet=%s', peer.remote_address, data.encode('hex'))
+			return
+		client_id = data[GTCP_CMD_SIZE:GTCP_HEADER_SIZE]
+		client = self._clients.get(client_id)
+		if client is None:
+			log.warn('tcp_server_peer_client_not_found|peer=%s,client_id=%s', peer.remote_address, client_id.encode('hex'))
+			return
+		client.send_packet(data[GTCP_HEADER_SIZE:], True)
+
+	def _forward_notify(self, client_id, data):
+		peer = self._gateway_peers.get(get_client_gateway(client_id))
+		if peer is None:
+			log.error('tcp_server_gateway_not_found|client_id=%s,reply=%s', client_id.encode('hex'), data.encode('hex'))
+			return
+		stats.incr('notify_forwarded')
+		peer.send(data)
+
+	def _on_multicast(self, data, forward=True):
+		multicast = unpack_multicast(data)
+		if multicast is None:
+			log.error('tcp_server_multicast_error|reply=%s', data.encode('hex'))
+			return
+		client_ids, packet = multicast
+		stats.incr('multicast')
+		stats.incr('multicast_client', len(client_ids))
+		# every local recipient gets the same bytes, frame them once
+		frame = struct.pack('<I', len(packet)) + packet
+		remote_client_ids = {}
+		for client_id in client_ids:
+			client = self._clients.get(client_id)
+			if client is not None:
+				client.send(frame, True)
+			elif forward and self._gateway_count > 1 and get_client_gateway(client_id) != self._gateway_index:
+				remote_client_ids.setdefault(get_client_gateway(client_id), []).append(client_id)
+			else:
+				log.warn('tcp_multicast_client_not_found|client_id=%s', client_id.encode('hex'))
+		for gateway_index, gateway_client_ids in remote_client_ids.iteritems():
+			peer = self._gateway_peers.get(gateway_index)
+			if peer is None:
+				log.error('tcp_server_gateway_not_found|gateway=%u,client_count=%u', gateway_index, len(gateway_client_ids))
+				continue
+			stats.incr('multicast_forwarded')
+			peer.send(pack_multicast(gateway_client_ids, packet))
+
 	def _on_worker_connect(self, stream, address):
-		worker = GTcpConnection(stream, address, self._config, self._on_worker_packet, self._on_worker_close)
-		worker.running_task = None
+		self._init_worker(WorkerConnection(stream, address, self._config, self._on_worker_packet, self._on_worker_close))
+
+	def _init_worker(self, worker):
+		worker.worker_id = None
+		worker.pool = None
+		worker.concurrent = False
+		worker.running_tasks = deque()
+		worker.inflight_frames = 0
+		worker.task_count = 0
+		worker.service_time_ewma = None
+		worker.waiting_tasks = self._create_task_queue()
+		worker.suspect = False
+		worker.task_timer = None
+		worker.busy_since = 0
 		log.info('tcp_server_worker_connect|id=%s,remote=%s', worker.id.encode('hex'), worker.remote_address)
+
+	def _on_worker_hello(self, worker, data):
+		if worker.worker_id is not None or len(data) < GTCP_HEADER_SIZE + 5:
+			log.error('tcp_worker_hello_error|worker=%s,hello=%s', worker.remote_address, data.encode('hex'))
+			worker.close()
+			return
+		(worker_id, flags) = struct.unpack_from('!IB', data, GTCP_HEADER_SIZE)
+		pool_name = data[GTCP_HEADER_SIZE + 5:] or GTCP_WORKER_POOL_DEFAULT
+		pool = self._worker_pools.get(pool_name)
+		if pool is None:
+			log.error('tcp_worker_hello_unknown_pool|worker=%s,worker_id=%u,pool=%s', worker.remote_address, worker_id, pool_name)
+			worker.close()
+			return
+		worker.worker_id = worker_id
+		worker.pool = pool
+		worker.concurrent = bool(flags & GTCP_WORKER_FLAG_CONCURRENT)
+		log.info('tcp_server_worker_hello|id=%s,remote=%s,worker_id=%u,pool=%s,concurrent=%s', worker.id.encode('hex'), worker.remote_address,
+			worker.worker_id, pool.name, worker.concurrent)
+		if worker.worker_id in pool.spare_worker_ids:
+			pool.spare_workers[worker.worker_id] = worker
+			return
+		self._activate_worker(worker)
+
+	def _activate_worker(self, worker):
+		worker.pool.add(worker)
+		if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+			self._add_sticky_worker(worker)
 		self._on_worker_idle(worker)
 
-	def _handle_task(self, client, cmd, data=''):
-		task = WorkerTask(client, cmd, data)
-		if self._idle_workers.empty():
-			self._waiting_tasks.put(task)
+	def _add_sticky_worker(self, worker):
+		pool = worker.pool
+		pool.sticky_workers[str(worker.worker_id)] = worker
+		self._rebuild_sticky_ring(pool)
+		# tasks that arrived while no worker was on the ring wait in the shared queue
+		while not pool.waiting_tasks.empty():
+			self._dispatch_task(pool.waiting_tasks.get())
+
+	def _remove_sticky_worker(self, worker):
+		pool = worker.pool
+		if pool.sticky_workers.get(str(worker.worker_id)) is worker:
+			del pool.sticky_workers[str(worker.worker_id)]
+			self._rebuild_sticky_ring(pool)
+
+	def _rebuild_sticky_ring(self, pool):
+		ring = self._conhash_class()
+		for index, name in enumerate(pool.sticky_workers.keys()):
+			ring.add_node(name, self._sticky_replica, index)
+		pool.sticky_ring = ring
+		# one version for all pools, a client only caches the worker of the pool it used last
+		self._sticky_ring_version += 1
+
+	def _get_sticky_worker(self, pool, client):
+		worker = client.sticky_worker
+		if client.sticky_ring_version == self._sticky_ring_version and worker is not None and worker.pool is pool:
+			return worker
+		if pool.sticky_workers:
+			worker = pool.sticky_workers.get(pool.sticky_ring.lookup(client.id.encode('hex')))
+		else:
+			worker = None
+		client.sticky_worker = worker
+		client.sticky_ring_version = self._sticky_ring_version
+		return worker
+
+	def _handle_sticky_task(self, task):
+		worker = self._get_sticky_worker(task.pool, task.client)
+		if worker is None:
+			task.pool.waiting_tasks.put(task)
+		elif worker.waiting_tasks.empty() and not worker.suspect and worker.inflight_frames < self._worker_max_inflight:
+			self._assign_task(worker, task)
+		else:
+			worker.waiting_tasks.put(task)
+
+	def _steal_tasks(self, worker):
+		victim = None
+		for other in worker.pool.sticky_workers.itervalues():
+			if other is not worker and other.waiting_tasks.size() > self._steal_threshold:
+				if victim is None or other.waiting_tasks.size() > victim.waiting_tasks.size():
+					victim = other
+		if victim is None:
+			return
+		while worker.inflight_frames < self._worker_max_inflight and victim.waiting_tasks.size() > self._steal_threshold:
+			tasks = self._get_waiting_tasks(victim.waiting_tasks, 1)
+			if not tasks:
+				return
+			task = tasks[0]
+			if self._get_task_lane(task) == GTCP_LANE_CONTROL:
+				# CONNECT and DISCONNECT stay on the client's sticky worker, in order with its other tasks
+				victim.waiting_tasks.put_back(task)
+				return
+			log.debug('tcp_server_steal_task|client_id=%s,worker_id=%u,victim_id=%u', task.client.id.encode('hex'), worker.worker_id, victim.worker_id)
+			self._assign_task(worker, task)
+
+	def _handle_task(self, client, cmd, data='', pool=None):
+		self._queued_task_count += 1
+		if self._queued_task_count > self._queued_task_max:
+			self._queued_task_max = self._queued_task_count
+		if self._queue_high_water and not self._reading_paused and self._queued_task_count >= self._queue_high_water:
+			self._pause_clients()
+		pool = pool or self._default_pool
+		if pool is not self._default_pool:
+			client.pool_tasks += 1
+		self._dispatch_task(WorkerTask(client, cmd, data, pool))
+
+	def _on_task_finished(self, task):
+		'''
+		called once a task has left its pool, answered or dropped
+		'''
+		if task.stand_in or task.pool is self._default_pool:
+			return
+		client = task.client
+		client.pool_tasks -= 1
+		if client.pool_tasks == 0 and client.disconnect_deferred:
+			client.disconnect_deferred = False
+			self._handle_task(client, GTCP_CMD_DISCONNECT, '')
+
+	def _on_task_dequeue(self, count=1):
+		self._queued_task_count -= count
+		if self._reading_paused and self._queued_task_count <= self._queue_low_water:
+			self._resume_clients()
+
+	def _pause_clients(self):
+		log.warn('tcp_server_pause_reading|queued=%u,high_water=%u', self._queued_task_count, self._queue_high_water)
+		stats.incr('client_read_pause')
+		self._reading_paused = True
+		for client in self._clients.itervalues():
+			client.pause_reading()
+
+	def _resume_clients(self):
+		log.info('tcp_server_resume_reading|queued=%u,low_water=%u', self._queued_task_count, self._queue_low_water)
+		self._reading_paused = False
+		for client in self._clients.values():
+			# packets a client had read before the pause can fill the queue up again
+			if self._reading_paused:
+				break
+			client.resume_reading()
+
+	@staticmethod
+	def _is_task_orphaned(task):
+		# nobody is left to read the reply, CONNECT and DISCONNECT still run so sessions stay balanced
+		return task.cmd == GTCP_CMD_RELAY and task.client.closed()
+
+	def _drop_orphaned_task(self, task):
+		log.debug('tcp_server_drop_orphaned_task|client_id=%s', task.client.id.encode('hex'))
+		stats.incr('task_client_closed')
+		self._on_task_dequeue()
+		self._on_task_finished(task)
+
+	def _get_waiting_tasks(self, waiting_tasks, count, max_size=None):
+		'''
+		takes up to count tasks off the queue, skipping those of clients that closed meanwhile,
+		and with max_size only as many as a batch frame of at most max_size bytes holds, one at least
+		'''
+		tasks = []
+		size = GTCP_HEADER_SIZE
+		while len(tasks) < count and not waiting_tasks.empty():
+			task = waiting_tasks.get()
+			if self._is_task_orphaned(task):
+				self._drop_orphaned_task(task)
+				continue
+			if max_size is not None:
+				size += 4 + GTCP_HEADER_SIZE + len(task.packet)
+				if tasks and size > max_size:
+					waiting_tasks.put_back(task)
+					break
+			tasks.append(task)
+		return tasks
+
+	def _dispatch_task(self, task):
+		if self._is_task_orphaned(task):
+			self._drop_orphaned_task(task)
+		elif self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+			self._handle_sticky_task(task)
+		elif not task.pool.has_idle():
+			task.pool.waiting_tasks.put(task)
 		else:
-			self._assign_task(self._idle_workers.get(), task)
+			worker = task.pool.get_idle()
+			self._assign_task(worker, task)
+			self._on_worker_idle(worker)
+
+	def _on_client_idle(self, client):
+		if self._reading_paused:
+			# the gateway stopped reading, the client's silence proves nothing
+			self._idle_wheel.add(client)
+			return
+		log.info('tcp_server_client_idle_timeout|id=%s,remote=%s', client.id.encode('hex'), client.remote_address)
+		stats.incr('client_idle_timeout')
+		client.close()
 
 	def _on_client_packet(self, client, data):
-		self._handle_task(client, GTCP_CMD_RELAY, data)
+		if self._idle_wheel is not None:
+			self._idle_wheel.touch(client)
+		if self._inline_handlers and self._handle_inline(client, data):
+			return
+		# only requests are refused, CONNECT and DISCONNECT are always queued so sessions are never leaked
+		if self._max_queue_size and self._queued_task_count >= self._max_queue_size:
+			log.warn('tcp_server_queue_full|id=%s,remote=%s,queued=%u', client.id.encode('hex'), client.remote_address, self._queued_task_count)
+			self._reject_packet(client, data, GTCP_ERROR_OVERLOAD)
+			return
+		pool = self._route_packet(data)
+		if self._max_client_tasks and (self._fair_quantum or self._task_lanes):
+			if self._get_client_task_queue(pool, client).client_size(client) >= self._max_client_tasks:
+				log.warn('tcp_server_client_task_limit|id=%s,remote=%s,limit=%u', client.id.encode('hex'), client.remote_address, self._max_client_tasks)
+				self._reject_packet(client, data, GTCP_ERROR_CLIENT_LIMIT)
+				return
+		self._handle_task(client, GTCP_CMD_RELAY, data, pool)
+
+	def _route_packet(self, data):
+		if len(self._worker_pools) == 1:
+			return self._default_pool
+		try:
+			name = self._default_pool.processor_class.route_packet(data)
+		except Exception as ex:
+			log.exception('tcp_server_route_packet_exception|ex=%s', ex)
+			return self._default_pool
+		return self._worker_pools.get(name, self._default_pool)
+
+	def _handle_inline(self, client, data):
+		'''
+		returns True once an inline handler has served the request
+		'''
+		try:
+			command = self._processor_class.packet_command(data)
+		except Exception as ex:
+			log.exception('tcp_server_packet_command_exception|ex=%s', ex)
+			return False
+		handler = self._inline_handlers.get(command)
+		if handler is None:
+			return False
+		start_time = time.time()
+		try:
+			reply = handler(client, data)
+		except Exception as ex:
+			log.exception('tcp_server_inline_handler_exception|command=%s,ex=%s', command, ex)
+			stats.incr('inline_handler_exception')
+			self._on_inline_overrun(command)
+			return False
+		elapsed = time.time() - start_time
+		stats.incr('inline_task_count')
+		stats.observe('inline_service_time', elapsed)
+		if elapsed > self._inline_budget:
+			log.warn('tcp_server_inline_handler_overrun|command=%s,elapsed=%.6f,budget=%.6f', command, elapsed, self._inline_budget)
+			stats.incr('inline_handler_overrun')
+			self._on_inline_overrun(command)
+		else:
+			self._inline_overruns[command] = 0
+		if reply is not None:
+			client.send_packet(reply)
+		return True
+
+	def _on_inline_overrun(self, command):
+		self._inline_overruns[command] += 1
+		if self._inline_overruns[command] >= self._inline_max_overruns:
+			log.error('tcp_server_inline_handler_disabled|command=%s,overruns=%u', command, self._inline_overruns[command])
+			stats.incr('inline_handler_disabled')
+			del self._inline_handlers[command]
+			del self._inline_overruns[command]
+
+	def _reject_packet(self, client, data, error):
+		stats.incr('task_rejected_' + error)
+		if self._overload_reply:
+			self._reply_error(client, data, error)
 		
 	def _on_client_close(self, client):
 		log.info('tcp_server_client_close|id=%s,remote=%s', client.id.encode('hex'), client.remote_address)
 		if client.id not in self._clients:
 			log.error('tcp_server_close_conn_not_found|id=%s,remote=%s', client.id.encode('hex'), client.remote_address)
 			return
-		self._handle_task(client, GTCP_CMD_DISCONNECT, '')
+		if self._idle_wheel is not None:
+			self._idle_wheel.remove(client)
+		if client.pool_tasks:
+			# CONNECT and DISCONNECT run in the default pool, the session outlives the client's requests in other pools
+			client.disconnect_deferred = True
+		else:
+			self._handle_task(client, GTCP_CMD_DISCONNECT, '')
 		del self._clients[client.id]
 		
 	def _on_worker_packet(self, worker, data):
-		client = worker.running_task.client
+		reply_cmd = data[:GTCP_CMD_SIZE]
+		if reply_cmd == GTCP_CMD_WORKER_HELLO:
+			self._on_worker_hello(worker, data)
+			return
+		if reply_cmd == GTCP_CMD_BATCH:
+			frames = unpack_batch(data)
+			if frames is None:
+				log.error('tcp_worker_batch_error|worker=%s,reply=%s', worker.remote_address, data.encode('hex'))
+				worker.close()
+				return
+		else:
+			frames = (data,)
+		done_tasks = []
+		done_frames = 0
+		for frame in frames:
+			task = self._on_worker_reply(worker, frame)
+			if task is not None:
+				done_tasks.append(task)
+				if task.batch_last:
+					done_frames += 1
+		if done_tasks:
+			# a batch reply can come in several frames, the request frame is done with the reply to its last task
+			worker.inflight_frames -= done_frames
+			if worker.inflight_frames == 0:
+				worker.pool.set_running(worker, False)
+			self._on_worker_tasks_done(worker, done_tasks)
+			for task in done_tasks:
+				self._on_task_finished(task)
+
+	def _on_worker_reply(self, worker, data):
+		if data[:GTCP_CMD_SIZE] == GTCP_CMD_MULTICAST:
+			self._on_multicast(data)
+			return None
+		if not worker.running_tasks:
+			log.error('tcp_worker_reply_no_task|worker=%s,reply=%s', worker.remote_address, data.encode('hex'))
+			return None
+		task = worker.running_tasks[0]
+		client = task.client
 		packet_size = len(data)
 		if packet_size < GTCP_HEADER_SIZE:
 			log.error('tcp_worker_reply_error|client_id=%s,client=%s,reply=%s', client.id.encode('hex'), client.remote_address, data.encode('hex'))
-			worker.running_task.client.close()
-			return
+			client.close()
+			return None
 		reply_cmd = data[:1]
-		if reply_cmd == GTCP_CMD_RELAY or reply_cmd == GTCP_CMD_NOTIFY:
-			reply_client = data[GTCP_CMD_SIZE:GTCP_HEADER_SIZE]
+		reply_client = data[GTCP_CMD_SIZE:GTCP_HEADER_SIZE]
+		if reply_cmd == GTCP_CMD_RELAY and task.expired:
+			log.warn('tcp_worker_reply_expired|client_id=%s,client=%s', client.id.encode('hex'), client.remote_address)
+		elif reply_cmd == GTCP_CMD_RELAY or reply_cmd == GTCP_CMD_NOTIFY:
 			reply_data = data[GTCP_HEADER_SIZE:]
 			if reply_client in self._clients:
-				self._clients[reply_client].send_packet(reply_data)
+				self._clients[reply_client].send_packet(reply_data, reply_cmd == GTCP_CMD_NOTIFY)
+			elif reply_cmd == GTCP_CMD_NOTIFY and self._gateway_count > 1 and get_client_gateway(reply_client) != self._gateway_index:
+				self._forward_notify(reply_client, data)
 			else:
 				log.error('tcp_reply_client_not_found|client_id=%s,reply=%s', reply_client.encode('hex'), reply_data.encode('hex'))
-				worker.running_task.client.close()
-		if reply_cmd != GTCP_CMD_NOTIFY:
-			self._on_worker_idle(worker)
+				client.close()
+		if reply_cmd == GTCP_CMD_NOTIFY:
+			return None
+		# a worker handles its tasks in order, so every reply belongs to its oldest in-flight task
+		if reply_client != client.id:
+			log.error('tcp_worker_reply_mismatch|worker=%s,client_id=%s,reply_client_id=%s', worker.remote_address, client.id.encode('hex'), reply_client.encode('hex'))
+		return worker.running_tasks.popleft()
+
+	def _on_worker_tasks_done(self, worker, tasks):
+		now = time.time()
+		elapsed = now - worker.busy_since
+		# replies of a batch arrive together, share the time out between its tasks
+		service_time = elapsed / len(tasks)
+		for task in tasks:
+			stats.observe('task_service_time', service_time)
+		worker.pool.observe_service_time(worker, service_time)
+		if worker.task_timer is not None:
+			event_loop.remove_timeout(worker.task_timer)
+			worker.task_timer = None
+		if worker.suspect:
+			log.info('tcp_worker_recover|worker_id=%s,elapsed=%.3f', worker.worker_id, elapsed)
+			worker.suspect = False
+			if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+				self._add_sticky_worker(worker)
+		if worker.running_tasks:
+			self._start_task_timer(worker, now)
+		self._on_worker_idle(worker)
 		
 	def _on_worker_close(self, worker):
-		if worker.running_task is not None:
-			worker.running_task.client.close()
-		self._idle_workers.remove(worker)
-		self._running_workers.remove(worker)
+		if worker.task_timer is not None:
+			event_loop.remove_timeout(worker.task_timer)
+			worker.task_timer = None
+		running_tasks = worker.running_tasks
+		worker.running_tasks = deque()
+		worker.inflight_frames = 0
+		if running_tasks:
+			if worker.concurrent:
+				# every frame in flight can have reached a handler, running them again could repeat their side effects
+				started_count = len(running_tasks)
+			else:
+				# only the oldest frame can have reached the worker's handler, tasks behind it are given to another worker
+				started_count = self._count_frame_tasks(running_tasks)
+			for i in xrange(started_count):
+				task = running_tasks.popleft()
+				if not task.expired:
+					task.client.close()
+				self._on_task_finished(task)
+		pool = worker.pool
+		if pool is not None:
+			pool.remove(worker)
+			if pool.spare_workers.get(worker.worker_id) is worker:
+				del pool.spare_workers[worker.worker_id]
+			if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+				self._remove_sticky_worker(worker)
+		# stand-ins are left out, their tasks are with another worker already
+		self._dispatch_running_tasks([task for task in running_tasks if not task.stand_in])
+		self._dispatch_waiting_tasks(worker)
+
+	def _dispatch_running_tasks(self, tasks):
+		self._queued_task_count += len(tasks)
+		for task in tasks:
+			self._dispatch_task(task)
+
+	def _dispatch_waiting_tasks(self, worker):
+		# only sticky routing queues tasks on a worker
+		while not worker.waiting_tasks.empty():
+			self._dispatch_task(worker.waiting_tasks.get())
 		
 	def _on_worker_idle(self, worker):
-		if self._waiting_tasks.empty():
-			self._idle_workers.put(worker)
+		if worker.suspect:
+			return
+		if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+			waiting_tasks = worker.waiting_tasks
 		else:
-			task = self._waiting_tasks.get()
-			self._assign_task(worker, task)
+			waiting_tasks = worker.pool.waiting_tasks
+		while worker.inflight_frames < self._worker_max_inflight:
+			tasks = self._get_waiting_tasks(waiting_tasks, self._worker_batch_size, self._max_batch_frame_size)
+			if len(tasks) > 1:
+				self._assign_tasks(worker, tasks)
+			elif tasks:
+				self._assign_task(worker, tasks[0])
+			else:
+				break
+		if self._worker_routing == GTCP_WORKER_ROUTING_STICKY and worker.inflight_frames < self._worker_max_inflight:
+			self._steal_tasks(worker)
+		if worker.inflight_frames < self._worker_max_inflight:
+			worker.pool.put_idle(worker)
 	
 	def _assign_task(self, worker, task):
-		worker.running_task = task
+		now = time.time()
+		stats.observe('task_queue_wait', now - task.enqueue_time)
+		task.batch_last = True
+		worker.running_tasks.append(task)
+		worker.inflight_frames += 1
+		worker.task_count += 1
 		worker.send_packet(task.cmd + task.client.id + task.packet)
-		self._running_workers.put(worker)
-		#TODO: set timeout
+		worker.pool.set_running(worker, True)
+		if len(worker.running_tasks) == 1:
+			self._start_task_timer(worker, now)
+		self._on_task_dequeue()
+
+	def _assign_tasks(self, worker, tasks):
+		now = time.time()
+		frames = []
+		for task in tasks:
+			stats.observe('task_queue_wait', now - task.enqueue_time)
+			task.batch_last = task is tasks[-1]
+			worker.running_tasks.append(task)
+			frames.append(task.cmd + task.client.id + task.packet)
+		worker.send_packet(pack_batch(frames))
+		worker.inflight_frames += 1
+		worker.task_count += len(tasks)
+		stats.incr('task_batch')
+		worker.pool.set_running(worker, True)
+		if len(worker.running_tasks) == len(tasks):
+			self._start_task_timer(worker, now)
+		self._on_task_dequeue(len(tasks))
+
+	def _start_task_timer(self, worker, now):
+		# the worker is busy with its oldest frame only, so that is the one on the clock
+		task = worker.running_tasks[0]
+		worker.busy_since = now
+		if self._task_timeout:
+			worker.task_timer = event_loop.add_timeout(self._task_timeout * self._count_frame_tasks(worker.running_tasks), self._on_task_timeout, worker, task)
+
+	@staticmethod
+	def _count_frame_tasks(running_tasks):
+		'''
+		tasks of the oldest frame in flight not answered yet
+		'''
+		count = 0
+		for task in running_tasks:
+			count += 1
+			if task.batch_last:
+				break
+		return count
+
+	def _on_task_timeout(self, worker, task):
+		worker.task_timer = None
+		if not worker.running_tasks or worker.running_tasks[0] is not task:
+			return
+		started_count = self._count_frame_tasks(worker.running_tasks)
+		for expired_task in list(islice(worker.running_tasks, started_count)):
+			self._expire_task(worker, expired_task)
+		worker.suspect = True
+		worker.pool.remove_idle(worker)
+		if self._worker_routing == GTCP_WORKER_ROUTING_STICKY:
+			# its clients go to the other workers until it recovers
+			self._remove_sticky_worker(worker)
+		# the frames behind the hung one are stuck with it
+		if worker.concurrent:
+			# they can have reached a handler already, running them elsewhere could repeat their side effects
+			for expired_task in list(islice(worker.running_tasks, started_count, None)):
+				self._expire_task(worker, expired_task)
+		else:
+			self._move_running_tasks(worker, started_count)
+		self._dispatch_waiting_tasks(worker)
+		if self._restart_on_timeout:
+			self._restart_worker(worker)
+
+	def _expire_task(self, worker, task):
+		if task.expired:
+			return
+		task.expired = True
+		stats.incr('task_timeout')
+		log.error('tcp_worker_task_timeout|worker_id=%s,client_id=%s,client=%s,cmd=%s,timeout=%s', worker.worker_id,
+			task.client.id.encode('hex'), task.client.remote_address, task.cmd.encode('hex'), self._task_timeout)
+		self._reply_task_error(task, GTCP_ERROR_TIMEOUT)
+
+	def _move_running_tasks(self, worker, started_count):
+		'''
+		gives the tasks behind the first started_count of a worker to other workers, their frames stay
+		with it under stand-ins, so should it recover and run them its replies to them are dropped
+		'''
+		running_tasks = worker.running_tasks
+		moved_tasks = []
+		for i in xrange(started_count, len(running_tasks)):
+			task = running_tasks[i]
+			if task.stand_in:
+				continue
+			stand_in = WorkerTask(task.client, task.cmd, task.packet, task.pool)
+			stand_in.batch_last = task.batch_last
+			stand_in.expired = True
+			stand_in.stand_in = True
+			running_tasks[i] = stand_in
+			moved_tasks.append(task)
+		if moved_tasks:
+			log.warn('tcp_worker_move_tasks|worker_id=%s,count=%u', worker.worker_id, len(moved_tasks))
+			stats.incr('task_moved', len(moved_tasks))
+			self._dispatch_running_tasks(moved_tasks)
+
+	def _reply_task_error(self, task, error):
+		if task.cmd != GTCP_CMD_RELAY:
+			return
+		self._reply_error(task.client, task.packet, error)
+
+	def _reply_error(self, client, request, error):
+		if client.closed():
+			return
+		try:
+			packet = self._processor_class.error_packet(request, error)
+		except Exception as ex:
+			log.exception('tcp_server_error_packet_exception|client_id=%s,error=%s,ex=%s', client.id.encode('hex'), error, ex)
+			return
+		if packet is not None:
+			client.send_packet(packet)
 
 def run():
 	IOLoop.instance().start()
@@ -0,0 +1,65 @@
+'''
+Hashed timing wheel for timeouts that are pushed back on every activity.
+
+One interval timer advances the wheel a slot per tick; an item sits in
+the slot its deadline hashes to. touch() only moves the deadline stored
+on the item, so it is O(1) and never touches the slots. When the wheel
+reaches the slot an item sits in, the item expires if its deadline has
+passed and is otherwise hashed again to the slot of its new deadline.
+
+Items carry wheel_deadline and wheel_slot attributes.
+'''
+import math
+import event_loop
+
+class TimingWheel(object):
+
+	def __init__(self, timeout, tick, on_expire):
+		self._tick = tick
+		self._timeout_ticks = max(1, int(math.ceil(float(timeout) / tick)))
+		self._slots = [set() for i in xrange(self._timeout_ticks + 1)]
+		self._current_tick = 0
+		self._on_expire_callback = on_expire
+		self._timer = None
+
+	def start(self):
+		if self._timer is None:
+			self._timer = event_loop.add_interval_timer(self._tick, self._on_tick)
+
+	def stop(self):
+		if self._timer is not None:
+			self._timer.stop()
+			self._timer = None
+
+	def size(self):
+		return sum(len(slot) for slot in self._slots)
+
+	def add(self, item):
+		item.wheel_deadline = self._current_tick + self._timeout_ticks
+		self._insert(item)
+
+	def touch(self, item):
+		item.wheel_deadline = self._current_tick + self._timeout_ticks
+
+	def remove(self, item):
+		self._slots[item.wheel_slot].discard(item)
+
+	def _insert(self, item):
+		item.wheel_slot = item.wheel_deadline % len(self._slots)
+		self._slots[item.wheel_slot].add(item)
+
+	def _on_tick(self):
+		self._current_tick += 1
+		slot_index = self._current_tick % len(self._slots)
+		slot = self._slots[slot_index]
+		if not slot:
+			return
+		self._slots[slot_index] = set()
+		expired_items = []
+		for item in slot:
+			if item.wheel_deadline <= self._current_tick:
+				expired_items.append(item)
+			else:
+				self._insert(item)
+		for item in expired_items:
+			self._on_expire_callback(item)
@@ -0,0 +1,221 @@
+'''
+Bookkeeping of the workers in one named pool of a GTcpServer.
+
+Workers are registered by the worker id of their hello, which also names
+their pool. Idle workers, those with a free in-flight slot, are kept in
+an idle set that picks the one given the next task:
+
+fifo: the worker idle the longest, spreading tasks evenly
+lifo: the worker idle the shortest, keeping a hot subset of workers busy
+least_outstanding: the worker with the fewest frames in flight
+ewma_p2c: the better of two random idle workers, scored by the moving
+average of their service time times their frames in flight plus one
+
+Running workers, those with frames in flight, are mapped by worker id.
+Every update is O(1), so churn stays cheap with hundreds of workers.
+'''
+import random
+from collections import OrderedDict
+
+WORKER_STATE_CONNECTING = 'connecting'
+WORKER_STATE_IDLE = 'idle'
+WORKER_STATE_RUNNING = 'running'
+WORKER_STATE_SUSPECT = 'suspect'
+
+WORKER_SELECTION_FIFO = 'fifo'
+WORKER_SELECTION_LIFO = 'lifo'
+WORKER_SELECTION_LEAST_OUTSTANDING = 'least_outstanding'
+WORKER_SELECTION_EWMA_P2C = 'ewma_p2c'
+
+class _FifoIdleSet(object):
+
+	def __init__(self):
+		self._workers = OrderedDict()
+
+	def __len__(self):
+		return len(self._workers)
+
+	def __contains__(self, worker):
+		return worker in self._workers
+
+	def add(self, worker):
+		# a worker already idle keeps its place
+		self._workers[worker] = None
+
+	def discard(self, worker):
+		self._workers.pop(worker, None)
+
+	def pop(self):
+		worker, _ = self._workers.popitem(last=False)
+		return worker
+
+class _LifoIdleSet(_FifoIdleSet):
+
+	def pop(self):
+		worker, _ = self._workers.popitem(last=True)
+		return worker
+
+class _LeastOutstandingIdleSet(object):
+	'''
+	idle workers bucketed by frames in flight, a worker added again moves to its current bucket
+	'''
+
+	def __init__(self):
+		self._buckets = {}
+		self._outstanding = {}
+
+	def __len__(self):
+		return len(self._outstanding)
+
+	def __contains__(self, worker):
+		return worker in self._outstanding
+
+	def add(self, worker):
+		outstanding = worker.inflight_frames
+		if self._outstanding.get(worker) == outstanding:
+			return
+		self.discard(worker)
+		bucket = self._buckets.get(outstanding)
+		if bucket is None:
+			bucket = self._buckets[outstanding] = OrderedDict()
+		bucket[worker] = None
+		self._outstanding[worker] = outstanding
+
+	def discard(self, worker):
+		outstanding = self._outstanding.pop(worker, None)
+		if outstanding is None:
+			return
+		bucket = self._buckets[outstanding]
+		del bucket[worker]
+		if not bucket:
+			del self._buckets[outstanding]
+
+	def pop(self):
+		# there are at most WORKER_MAX_INFLIGHT buckets
+		worker = next(iter(self._buckets[min(self._buckets)]))
+		self.discard(worker)
+		return worker
+
+class _EwmaP2cIdleSet(object):
+	'''
+	idle workers in a list for O(1) random picks, removed by moving the last one into their place
+	'''
+
+	def __init__(self):
+		self._workers = []
+		self._positions = {}
+
+	def __len__(self):
+		return len(self._workers)
+
+	def __contains__(self, worker):
+		return worker in self._positions
+
+	def add(self, worker):
+		if worker not in self._positions:
+			self._positions[worker] = len(self._workers)
+			self._workers.append(worker)
+
+	def discard(self, worker):
+		position = self._positions.pop(worker, None)
+		if position is None:
+			return
+		last = self._workers.pop()
+		if last is not worker:
+			self._workers[position] = last
+			self._positions[last] = position
+
+	def pop(self):
+		if len(self._workers) == 1:
+			worker = self._workers[0]
+		else:
+			first, second = random.sample(self._workers, 2)
+			worker = first if self._score(first) <= self._score(second) else second
+		self.discard(worker)
+		return worker
+
+	@staticmethod
+	def _score(worker):
+		# a worker without samples yet scores 0, so it is tried early
+		return (worker.service_time_ewma or 0) * (worker.inflight_frames + 1)
+
+_IDLE_SETS = {
+	WORKER_SELECTION_FIFO: _FifoIdleSet,
+	WORKER_SELECTION_LIFO: _LifoIdleSet,
+	WORKER_SELECTION_LEAST_OUTSTANDING: _LeastOutstandingIdleSet,
+	WORKER_SELECTION_EWMA_P2C: _EwmaP2cIdleSet,
+}
+
+class WorkerPool(object):
+
+	def __init__(self, name, selection=WORKER_SELECTION_FIFO, ewma_alpha=0.2):
+		self.name = name
+		self._workers = {}
+		self._idle_workers = _IDLE_SETS[selection]()
+		self._running_workers = {}
+		self._ewma_alpha = ewma_alpha
+
+	def add(self, worker):
+		'''
+		called once the worker has sent its hello and has a worker_id
+		'''
+		self._workers[worker.worker_id] = worker
+
+	def remove(self, worker):
+		self._idle_workers.discard(worker)
+		worker_id = worker.worker_id
+		if worker_id is None:
+			return
+		# a restarted worker can say hello under the same id before its old connection is gone
+		if self._workers.get(worker_id) is worker:
+			del self._workers[worker_id]
+		if self._running_workers.get(worker_id) is worker:
+			del self._running_workers[worker_id]
+
+	def size(self):
+		return len(self._workers)
+
+	def workers(self):
+		return self._workers.values()
+
+	def idle_count(self):
+		return len(self._idle_workers)
+
+	def running_count(self):
+		return len(self._running_workers)
+
+	def has_idle(self):
+		return len(self._idle_workers) > 0
+
+	def put_idle(self, worker):
+		'''
+		called whenever the worker has a free in-flight slot, idle already or not
+		'''
+		self._idle_workers.add(worker)
+
+	def get_idle(self):
+		return self._idle_workers.pop()
+
+	def remove_idle(self, worker):
+		self._idle_workers.discard(worker)
+
+	def set_running(self, worker, running):
+		if running:
+			self._running_workers[worker.worker_id] = worker
+		elif self._running_workers.get(worker.worker_id) is worker:
+			del self._running_workers[worker.worker_id]
+
+	def observe_service_time(self, worker, service_time):
+		if worker.service_time_ewma is None:
+			worker.service_time_ewma = service_time
+		else:
+			worker.service_time_ewma += self._ewma_alpha * (service_time - worker.service_time_ewma)
+
+	def get_state(self, worker):
+		if worker.worker_id is None:
+			return WORKER_STATE_CONNECTING
+		if worker.suspect:
+			return WORKER_STATE_SUSPECT
+		if worker.worker_id in self._running_workers:
+			return WORKER_STATE_RUNNING
+		return WORKER_STATE_IDLE
@@ -12,6 +12,20 @@ from im_server.model.data import *
 from im_server.model.data_schema import *
 from im_server.model import cache_manager
 
+# every PacketHeader field is a varint, the command is read off the wire without parsing the header
+_HEADER_COMMAND_FIELD = PacketHeader.DESCRIPTOR.fields_by_name['command'].number
+
+def _decode_varint(data, pos):
+	result = 0
+	shift = 0
+	while True:
+		byte = ord(data[pos])
+		result |= (byte & 0x7f) << shift
+		pos += 1
+		if not byte & 0x80:
+			return result, pos
+		shift += 7
+
 class RequestContext(object):
 
 	def __init__(self, processor, conn, header):
@@ -28,6 +42,7 @@ class ParamsError(Exception):
 class ProcessorManager(tcp_server.Processor):
 
 	_processors = {}
+	_pool_routes = {}
 
 	def on_client_connect(self, conn):
 		log.info('new_connect|client_id=%s,ip=%s', conn.id.encode("hex"), conn.ip)
@@ -119,16 +134,59 @@ class ProcessorManager(tcp_server.Processor):
 		return writer.buffer
 
 	@classmethod
-	def register_processor(cls, command, processor, req_pro, reply_pro, request_schema):
+	def error_packet(cls, request, error):
+		reader = BufferReader(request, '!')
+		header_size = reader.get_uint16()
+		header_buff = reader.get_buffer(header_size)
+		if reader.error:
+			return None
+		try:
+			header = PacketHeader.FromString(header_buff)
+		except:
+			return None
+		log.warn('gateway_error_reply|id=%s,version=%s,command=0x%02x,error=%s', header.id, header.version, header.command, error)
+		return cls.construct_reply_packet(Result.ERROR_SERVER, header)
+
+	@classmethod
+	def route_packet(cls, request):
+		if not cls._pool_routes:
+			return None
+		return cls._pool_routes.get(cls.packet_command(request))
+
+	@classmethod
+	def packet_command(cls, request):
+		# reads the command varint straight off the header bytes, skipping a full parse
+		reader = BufferReader(request, '!')
+		header_size = reader.get_uint16()
+		header_buff = reader.get_buffer(header_size)
+		if reader.error:
+			return None
+		pos = 0
+		try:
+			while pos < len(header_buff):
+				tag, pos = _decode_varint(header_buff, pos)
+				if tag & 0x7 != 0:
+					return None
+				value, pos = _decode_varint(header_buff, pos)
+				if tag >> 3 == _HEADER_COMMAND_FIELD:
+					return value
+		except IndexError:
+			return None
+		return None
+
+	@classmethod
+	def register_processor(cls, command, processor, req_pro, reply_pro, request_schema, pool=None):
 		if request_schema:
 			request_schema = PBValidator(request_schema)
 		if command in cls._processors:
 			log.assertion('register_command_duplicated|cmd=%s', command)
 		cls._processors[command] = (processor, req_pro, reply_pro, request_schema)
-		log.info("register_command|cmd=%s", command)
+		if pool is not None:
+			cls._pool_routes[command] = pool
+		log.info("register_command|cmd=%s,pool=%s", command, pool)
 
-def register_processor(command, request_type=None, reply_type=None, request_schema=None):
+def register_processor(command, request_type=None, reply_type=None, request_schema=None, pool=None):
 	def _register_processor(func):
-		ProcessorManager.register_processor(command, func, request_type, reply_type, request_schema)
+		ProcessorManager.register_processor(command, func, request_type, reply_type, request_schema, pool)
 		return func
-	return _register_processor
\ No newline at end of file
+	return _register_processor
\ No newline at end of file
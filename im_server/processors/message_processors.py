@@ -1,6 +1,6 @@
 from manager import *
 
-@register_processor(Command.CMD_MESSAGE_SEND, MessageSendRequest, None, MessageSendRequestSchema)
+@register_processor(Command.CMD_MESSAGE_SEND, MessageSendRequest, None, MessageSendRequestSchema, pool='slow')
 def on_message_send(context, request, reply):
 	current_client_id = context.conn.id.encode("hex")
 	from_username = cache_manager.get_username(current_client_id)
@@ -23,10 +23,11 @@ def on_message_send(context, request, reply):
 
 	notify_packet = context.processor.construct_reply_packet(Result.SUCCESS, notify_header, notify_request)
 
-	for username, client_id in client_id_dict.iteritems():
-		if not context.processor.send_packet(client_id.decode("hex"), notify_packet):
-			log.warn("notify_message_fail|from_username=%s,from_client_id=%s,to_username=%s,to_client_id=%s,message=%s", from_username, current_client_id, username, client_id, request.message.content)
-			return Result.ERROR_SERVER
+	client_ids = [client_id.decode("hex") for client_id in client_id_dict.itervalues()]
+	if not context.processor.send_packet_many(client_ids, notify_packet):
+		log.warn("notify_message_fail|from_username=%s,from_client_id=%s,to_usernames=%s,message=%s", from_username, current_client_id, ",".join(client_id_dict.iterkeys()), request.message.content)
+		return Result.ERROR_SERVER
+	for username in client_id_dict.iterkeys():
 		log.data("notify_message|from_username=%s,to_username=%s,message=%s", from_username, username, request.message.content)
 
-	return Result.SUCCESS
\ No newline at end of file
+	return Result.SUCCESS
\ No newline at end of file
@@ -0,0 +1,55 @@
+import os
+import sys
+import struct
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../'))
+
+from gtcp.frame_decoder import FrameDecoder
+
+def frame(body):
+	return struct.pack('<I', len(body)) + body
+
+class FrameDecoderTest(unittest.TestCase):
+
+	def test_frames_in_one_feed(self):
+		decoder = FrameDecoder()
+		self.assertEqual(decoder.feed(frame('a') + frame('') + frame('bcd')), ['a', '', 'bcd'])
+		self.assertEqual(decoder.buffered_size(), 0)
+
+	def test_byte_by_byte(self):
+		decoder = FrameDecoder()
+		data = frame('hello') + frame('world')
+		frames = []
+		for i in xrange(len(data)):
+			frames.extend(decoder.feed(data[i]))
+			# both frames take 9 bytes
+			self.assertEqual(decoder.buffered_size(), (i + 1) % 9)
+		self.assertEqual(frames, ['hello', 'world'])
+		self.assertEqual(decoder.buffered_size(), 0)
+
+	def test_partial_frame_is_kept(self):
+		decoder = FrameDecoder()
+		data = frame('first') + frame('second')
+		self.assertEqual(decoder.feed(data[:12]), ['first'])
+		self.assertEqual(decoder.buffered_size(), 3)
+		# the header is not complete yet
+		self.assertEqual(decoder.frame_size, 5)
+		self.assertEqual(decoder.feed(data[12:15]), [])
+		self.assertEqual(decoder.frame_size, 6)
+		self.assertEqual(decoder.feed(data[15:] + frame('x')[:2]), ['second'])
+		self.assertEqual(decoder.buffered_size(), 2)
+		self.assertEqual(decoder.feed(frame('x')[2:]), ['x'])
+
+	def test_oversized_frame_sets_error(self):
+		decoder = FrameDecoder(8)
+		self.assertEqual(decoder.feed(frame('1234567') + frame('12345678') + frame('a')), ['1234567'])
+		self.assertTrue(decoder.error)
+		self.assertEqual(decoder.frame_size, 8)
+		self.assertEqual(decoder.feed(frame('a')), [])
+		decoder.reset()
+		self.assertFalse(decoder.error)
+		self.assertEqual(decoder.feed(frame('a')), ['a'])
+
+if __name__ == '__main__':
+	unittest.main()
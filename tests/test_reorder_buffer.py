@@ -0,0 +1,37 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../'))
+
+from gtcp.reorder_buffer import ReorderBuffer
+
+class ReorderBufferTest(unittest.TestCase):
+
+	def test_in_order(self):
+		buf = ReorderBuffer()
+		for i in xrange(3):
+			self.assertEqual(buf.put(buf.reserve(), i), [i])
+		self.assertEqual(buf.pending_count(), 0)
+
+	def test_out_of_order_results_wait(self):
+		buf = ReorderBuffer()
+		seqs = [buf.reserve() for i in xrange(4)]
+		self.assertEqual(buf.pending_count(), 4)
+		self.assertEqual(list(buf.put(seqs[2], 'c')), [])
+		self.assertEqual(list(buf.put(seqs[1], 'b')), [])
+		self.assertEqual(buf.pending_count(), 4)
+		self.assertEqual(buf.put(seqs[0], 'a'), ['a', 'b', 'c'])
+		self.assertEqual(buf.pending_count(), 1)
+		self.assertEqual(buf.put(seqs[3], 'd'), ['d'])
+		self.assertEqual(buf.pending_count(), 0)
+
+	def test_gap_holds_later_results(self):
+		buf = ReorderBuffer()
+		seqs = [buf.reserve() for i in xrange(3)]
+		self.assertEqual(buf.put(seqs[0], 'a'), ['a'])
+		self.assertEqual(list(buf.put(seqs[2], 'c')), [])
+		self.assertEqual(buf.put(seqs[1], 'b'), ['b', 'c'])
+
+if __name__ == '__main__':
+	unittest.main()
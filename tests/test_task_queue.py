@@ -0,0 +1,123 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../'))
+
+from gtcp.task_queue import LaneQueue, FairQueue, FAIR_TASK_OVERHEAD
+
+class Client(object):
+
+	def __init__(self):
+		self.queued_tasks = 0
+		self.queued_lane = None
+
+class Task(object):
+
+	def __init__(self, client, name, lane=None, packet=''):
+		self.client = client
+		self.name = name
+		self.lane = lane
+		self.packet = packet
+
+	def __repr__(self):
+		return self.name
+
+def classify(task):
+	return task.lane
+
+def drain(queue):
+	names = []
+	while not queue.empty():
+		names.append(queue.get().name)
+	return names
+
+class LaneQueueTest(unittest.TestCase):
+
+	def setUp(self):
+		self.queue = LaneQueue([('control', 2), ('relay', 1)], classify)
+
+	def test_weighted_round_robin(self):
+		for name in ('c1', 'c2', 'c3'):
+			self.queue.put(Task(Client(), name, 'control'))
+		for name in ('r1', 'r2', 'r3'):
+			self.queue.put(Task(Client(), name, 'relay'))
+		self.assertEqual(self.queue.lane_sizes(), {'control': 3, 'relay': 3})
+		self.assertEqual(drain(self.queue), ['c1', 'c2', 'r1', 'c3', 'r2', 'r3'])
+		self.assertEqual(self.queue.size(), 0)
+
+	def test_put_back_refunds_credit(self):
+		for name in ('c1', 'c2', 'c3'):
+			self.queue.put(Task(Client(), name, 'control'))
+		self.queue.put(Task(Client(), 'r1', 'relay'))
+		task = self.queue.get()
+		self.assertEqual(task.name, 'c1')
+		self.queue.put_back(task)
+		self.assertEqual(task.client.queued_tasks, 1)
+		self.assertEqual(self.queue.size(), 4)
+		# c1 is served again without using up the credit of c2
+		self.assertEqual(drain(self.queue), ['c1', 'c2', 'r1', 'c3'])
+
+	def test_client_tasks_stay_in_their_lane(self):
+		client = Client()
+		self.queue.put(Task(client, 'a1', 'relay'))
+		self.queue.put(Task(client, 'a2', 'control'))
+		self.queue.put(Task(Client(), 'c1', 'control'))
+		self.assertEqual(self.queue.lane_sizes(), {'control': 1, 'relay': 2})
+		self.assertEqual(self.queue.client_size(client), 2)
+		self.assertEqual(drain(self.queue), ['c1', 'a1', 'a2'])
+		# once the client has nothing queued its next task is classified again
+		self.queue.put(Task(client, 'a3', 'control'))
+		self.assertEqual(self.queue.lane_sizes(), {'control': 1, 'relay': 0})
+
+	def test_lane_of_another_queue_is_not_kept(self):
+		other = LaneQueue([('control', 2), ('relay', 1)], classify)
+		client = Client()
+		other.put(Task(client, 'a1', 'relay'))
+		self.queue.put(Task(client, 'a2', 'control'))
+		self.assertEqual(self.queue.lane_sizes(), {'control': 1, 'relay': 0})
+		self.assertEqual(other.lane_sizes(), {'control': 0, 'relay': 1})
+		self.assertEqual(client.queued_tasks, 2)
+		self.assertEqual(drain(other), ['a1'])
+		self.assertEqual(drain(self.queue), ['a2'])
+		self.assertEqual(client.queued_tasks, 0)
+
+class FairQueueTest(unittest.TestCase):
+
+	def setUp(self):
+		self.quantum = 100
+		self.queue = FairQueue(self.quantum)
+
+	def packet(self, cost):
+		return 'x' * (cost - FAIR_TASK_OVERHEAD)
+
+	def test_clients_take_turns(self):
+		a, b = Client(), Client()
+		for name in ('a1', 'a2', 'a3'):
+			self.queue.put(Task(a, name, packet=self.packet(self.quantum)))
+		self.queue.put(Task(b, 'b1', packet=self.packet(self.quantum)))
+		self.assertEqual(self.queue.client_size(a), 3)
+		self.assertEqual(drain(self.queue), ['a1', 'b1', 'a2', 'a3'])
+		self.assertEqual(self.queue.client_size(a), 0)
+
+	def test_large_task_builds_up_deficit(self):
+		a, b = Client(), Client()
+		self.queue.put(Task(a, 'a1', packet=self.packet(self.quantum * 5)))
+		for name in ('b1', 'b2', 'b3'):
+			self.queue.put(Task(b, name, packet=self.packet(self.quantum)))
+		self.assertEqual(drain(self.queue), ['b1', 'b2', 'b3', 'a1'])
+
+	def test_put_back_refunds_deficit(self):
+		a, b = Client(), Client()
+		self.queue.put(Task(a, 'a1', packet=self.packet(self.quantum)))
+		self.queue.put(Task(b, 'b1', packet=self.packet(self.quantum)))
+		task = self.queue.get()
+		self.assertEqual(task.name, 'a1')
+		# the flow of a was emptied by get, put_back brings it back at the front
+		self.queue.put_back(task)
+		self.assertEqual(self.queue.size(), 2)
+		self.assertEqual(self.queue.client_size(a), 1)
+		self.assertEqual(drain(self.queue), ['a1', 'b1'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../'))
+
+from gtcp.timing_wheel import TimingWheel
+
+class Item(object):
+	pass
+
+class TimingWheelTest(unittest.TestCase):
+
+	def setUp(self):
+		self.expired = []
+		# never started, the tests advance the wheel themselves
+		self.wheel = TimingWheel(3, 1, self.expired.append)
+
+	def tick(self, count=1):
+		for i in xrange(count):
+			self.wheel._on_tick()
+
+	def test_expires_after_timeout(self):
+		item = Item()
+		self.wheel.add(item)
+		self.assertEqual(self.wheel.size(), 1)
+		self.tick(2)
+		self.assertEqual(self.expired, [])
+		self.tick()
+		self.assertEqual(self.expired, [item])
+		self.assertEqual(self.wheel.size(), 0)
+
+	def test_touched_item_is_hashed_again(self):
+		item = Item()
+		self.wheel.add(item)
+		self.tick(2)
+		self.wheel.touch(item)
+		self.assertEqual(item.wheel_deadline, 5)
+		# reaching its old slot moves it to the slot of its new deadline
+		self.tick()
+		self.assertEqual(self.expired, [])
+		self.assertEqual(item.wheel_slot, 5 % 4)
+		self.assertEqual(self.wheel.size(), 1)
+		self.tick()
+		self.assertEqual(self.expired, [])
+		self.tick()
+		self.assertEqual(self.expired, [item])
+
+	def test_touch_past_a_full_turn(self):
+		item = Item()
+		self.wheel.add(item)
+		for i in xrange(10):
+			self.tick()
+			self.wheel.touch(item)
+		self.assertEqual(self.expired, [])
+		self.tick(3)
+		self.assertEqual(self.expired, [item])
+
+	def test_removed_item_does_not_expire(self):
+		item, other = Item(), Item()
+		self.wheel.add(item)
+		self.wheel.add(other)
+		self.wheel.remove(item)
+		self.tick(4)
+		self.assertEqual(self.expired, [other])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../'))
+
+from gtcp.worker_pool import (WorkerPool, WORKER_SELECTION_FIFO, WORKER_SELECTION_LIFO, WORKER_SELECTION_LEAST_OUTSTANDING,
+	WORKER_SELECTION_EWMA_P2C, WORKER_STATE_CONNECTING, WORKER_STATE_IDLE, WORKER_STATE_RUNNING, WORKER_STATE_SUSPECT)
+
+class Worker(object):
+
+	def __init__(self, worker_id, inflight_frames=0, service_time_ewma=None):
+		self.worker_id = worker_id
+		self.inflight_frames = inflight_frames
+		self.service_time_ewma = service_time_ewma
+		self.suspect = False
+
+	def __repr__(self):
+		return 'Worker(%s)' % self.worker_id
+
+def idle_pool(selection, workers):
+	pool = WorkerPool('default', selection)
+	for worker in workers:
+		pool.add(worker)
+		pool.put_idle(worker)
+	return pool
+
+class WorkerSelectionTest(unittest.TestCase):
+
+	def test_fifo(self):
+		workers = [Worker(i) for i in xrange(3)]
+		pool = idle_pool(WORKER_SELECTION_FIFO, workers)
+		# an idle worker put again keeps its place
+		pool.put_idle(workers[0])
+		self.assertEqual([pool.get_idle() for i in xrange(3)], workers)
+		self.assertFalse(pool.has_idle())
+
+	def test_lifo(self):
+		workers = [Worker(i) for i in xrange(3)]
+		pool = idle_pool(WORKER_SELECTION_LIFO, workers)
+		self.assertEqual([pool.get_idle() for i in xrange(3)], workers[::-1])
+
+	def test_least_outstanding(self):
+		workers = [Worker(0, 2), Worker(1, 1), Worker(2, 1)]
+		pool = idle_pool(WORKER_SELECTION_LEAST_OUTSTANDING, workers)
+		self.assertEqual(pool.get_idle(), workers[1])
+		# put again with fewer frames in flight, it moves to its new bucket
+		workers[0].inflight_frames = 0
+		pool.put_idle(workers[0])
+		self.assertEqual(pool.idle_count(), 2)
+		self.assertEqual(pool.get_idle(), workers[0])
+		self.assertEqual(pool.get_idle(), workers[2])
+
+	def test_ewma_p2c(self):
+		slow, fast = Worker(0, 0, 0.5), Worker(1, 0, 0.1)
+		pool = idle_pool(WORKER_SELECTION_EWMA_P2C, [slow, fast])
+		self.assertEqual(pool.get_idle(), fast)
+		self.assertEqual(pool.get_idle(), slow)
+		# frames in flight weigh in the score
+		slow.inflight_frames, fast.inflight_frames = 0, 5
+		pool.put_idle(slow)
+		pool.put_idle(fast)
+		self.assertEqual(pool.get_idle(), slow)
+
+	def test_remove_idle(self):
+		for selection in (WORKER_SELECTION_FIFO, WORKER_SELECTION_LIFO, WORKER_SELECTION_LEAST_OUTSTANDING, WORKER_SELECTION_EWMA_P2C):
+			workers = [Worker(i) for i in xrange(3)]
+			pool = idle_pool(selection, workers)
+			pool.remove_idle(workers[1])
+			pool.remove_idle(workers[1])
+			self.assertEqual(pool.idle_count(), 2)
+			self.assertEqual(sorted(pool.get_idle().worker_id for i in xrange(2)), [0, 2])
+
+class WorkerPoolTest(unittest.TestCase):
+
+	def test_states(self):
+		pool = WorkerPool('default')
+		worker = Worker(None)
+		self.assertEqual(pool.get_state(worker), WORKER_STATE_CONNECTING)
+		worker.worker_id = 1
+		pool.add(worker)
+		pool.put_idle(worker)
+		self.assertEqual(pool.get_state(worker), WORKER_STATE_IDLE)
+		pool.set_running(worker, True)
+		self.assertEqual(pool.get_state(worker), WORKER_STATE_RUNNING)
+		self.assertEqual(pool.running_count(), 1)
+		worker.suspect = True
+		self.assertEqual(pool.get_state(worker), WORKER_STATE_SUSPECT)
+		pool.set_running(worker, False)
+		self.assertEqual(pool.running_count(), 0)
+
+	def test_remove_keeps_restarted_worker(self):
+		pool = WorkerPool('default')
+		old, new = Worker(1), Worker(1)
+		pool.add(old)
+		pool.set_running(old, True)
+		pool.add(new)
+		pool.set_running(new, True)
+		pool.remove(old)
+		self.assertEqual(pool.workers(), [new])
+		self.assertEqual(pool.running_count(), 1)
+		pool.remove(new)
+		self.assertEqual(pool.size(), 0)
+		self.assertEqual(pool.running_count(), 0)
+
+	def test_observe_service_time(self):
+		pool = WorkerPool('default', ewma_alpha=0.5)
+		worker = Worker(1)
+		pool.observe_service_time(worker, 1.0)
+		self.assertEqual(worker.service_time_ewma, 1.0)
+		pool.observe_service_time(worker, 3.0)
+		self.assertEqual(worker.service_time_ewma, 2.0)
+
+if __name__ == '__main__':
+	unittest.main()